@@ -0,0 +1,337 @@
+import argparse
+import gzip
+import os
+
+import numpy as np
+
+import pysam
+
+
+def makeGenome(nChroms, genomeSize):
+    """ Return a dictionary with the lengths of nChroms chromosomes
+    (chr1, chr2...) of decreasing lengths whose sum is genomeSize"""
+    weights = 1 / np.sqrt(np.arange(1, nChroms + 1))
+    lengths = (weights / weights.sum() * genomeSize).astype(np.int64)
+    return {'chr%i' % (i + 1): int(length)
+            for i, length in enumerate(lengths)}
+
+
+def makeRestrictionSites(genome, siteSpacing, rng):
+    """ Return a dictionary with the sorted positions (1-based) of the
+    restriction sites of each chromosome, every siteSpacing bp on average"""
+    sites = {}
+    for chrom, length in genome.items():
+        gaps = rng.geometric(1 / siteSpacing,
+                             size=int(length / siteSpacing * 1.2) + 10)
+        positions = np.cumsum(gaps)
+        sites[chrom] = positions[positions < length]
+    return sites
+
+
+def writeDigest(fileName, genome, sites):
+    """ Write the fragments between the restriction sites like the output
+    of hicup_digester (2 header lines, one fragment per line)"""
+    with open(fileName, 'w') as fo:
+        fo.write("Genome:synthetic\tRestriction_Enzyme1:re1 [A^AGCTT]"
+                 "\tRestriction_Enzyme2:None\tHicup digester version 0.6.1\n")
+        fo.write("Chromosome\tFragment_Start_Position\tFragment_End_Position"
+                 "\tFragment_Number\tRE1_Fragment_Number"
+                 "\t5'_Restriction_Site\t3'_Restriction_Site\n")
+        for chrom, length in genome.items():
+            starts = np.concatenate(([1], sites[chrom] + 1))
+            ends = np.concatenate((sites[chrom], [length]))
+            nFrags = len(starts)
+            left = ['Re1'] * nFrags
+            left[0] = 'None'
+            right = ['Re1'] * nFrags
+            right[-1] = 'None'
+            fo.write("".join("%s\t%i\t%i\t%i\t%i\t%s\t%s\n"
+                             % (chrom, start, end, i + 1, i + 1, l5, r3)
+                             for i, (start, end, l5, r3)
+                             in enumerate(zip(starts.tolist(), ends.tolist(),
+                                              left, right))))
+
+
+def writeHicupBam(fileName, genome, sites, nPairs, rng, readLength=50,
+                  transFraction=0.2):
+    """ Write nPairs pairs like the output of hicup (unsorted, the 2 reads
+    of a pair are consecutive). Each read starts near a restriction site,
+    the distance between the fragments of cis pairs follows a power law."""
+    chroms = list(genome)
+    lengths = np.array([genome[chrom] for chrom in chroms], dtype=np.float64)
+    header = {'HD': {'VN': '1.0', 'SO': 'unsorted'},
+              'SQ': [{'SN': chrom, 'LN': genome[chrom]} for chrom in chroms],
+              'PG': [{'ID': 'generate_data.py'}]}
+    chr1 = rng.choice(len(chroms), size=nPairs, p=lengths / lengths.sum())
+    chr2 = np.where(rng.random(nPairs) < transFraction,
+                    rng.choice(len(chroms), size=nPairs,
+                               p=lengths / lengths.sum()),
+                    chr1)
+    frag1 = rng.random(nPairs)
+    distance = np.round(10 ** rng.uniform(0, 3, size=nPairs)).astype(np.int64)
+    distance *= rng.choice([-1, 1], size=nPairs)
+    frag2 = rng.random(nPairs)
+    strands = rng.integers(0, 2, size=(nPairs, 2))
+    offsets = rng.integers(0, 400, size=(nPairs, 2))
+    mapqs = np.where(rng.random((nPairs, 2)) < 0.9, 42,
+                     rng.integers(0, 42, size=(nPairs, 2)))
+
+    def readStart(chrId, site, strand, offset):
+        # The read goes away from the restriction site
+        chrSites = sites[chroms[chrId]]
+        position = int(chrSites[site])
+        if strand:
+            position -= offset + readLength
+        else:
+            position += offset
+        return min(max(position, 0), genome[chroms[chrId]] - readLength)
+
+    with pysam.AlignmentFile(fileName, 'wb', header=header) as fo:
+        read = pysam.AlignedSegment(fo.header)
+        read.query_sequence = 'A' * readLength
+        read.query_qualities = pysam.qualitystring_to_array('C' * readLength)
+        read.cigarstring = '%iM' % readLength
+        for i in range(nPairs):
+            nSites1 = len(sites[chroms[chr1[i]]])
+            site1 = int(frag1[i] * nSites1)
+            if chr2[i] == chr1[i]:
+                site2 = min(max(site1 + int(distance[i]), 0), nSites1 - 1)
+            else:
+                site2 = int(frag2[i] * len(sites[chroms[chr2[i]]]))
+            positions = (readStart(chr1[i], site1, strands[i, 0],
+                                   offsets[i, 0]),
+                         readStart(chr2[i], site2, strands[i, 1],
+                                   offsets[i, 1]))
+            chrIds = (int(chr1[i]), int(chr2[i]))
+            for mate in range(2):
+                other = 1 - mate
+                read.query_name = 'SYN.%i' % i
+                read.flag = 1 + 2 + (64, 128)[mate] + \
+                    16 * int(strands[i, mate]) + 32 * int(strands[i, other])
+                read.reference_id = chrIds[mate]
+                read.reference_start = positions[mate]
+                read.mapping_quality = int(mapqs[i, mate])
+                read.next_reference_id = chrIds[other]
+                read.next_reference_start = positions[other]
+                fo.write(read)
+
+
+def writeAtacBam(fileName, genome, nFragments, rng, readLength=50,
+                 peakSpacing=20000, fractionInPeaks=0.5):
+    """ Write a coordinate-sorted and indexed bam with nFragments paired-end
+    ATAC-seq fragments: the fragments in peaks are around peak centers
+    every peakSpacing bp on average, the others are uniform.
+    The fragment sizes have the nucleosome-free, mono- and di-nucleosome
+    modes. 5% of the pairs are duplicates and 10% have a low mapping
+    quality."""
+    chroms = list(genome)
+    lengths = np.array([genome[chrom] for chrom in chroms], dtype=np.float64)
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': genome[chrom]} for chrom in chroms],
+              'PG': [{'ID': 'generate_data.py'}]}
+    counts = rng.multinomial(nFragments, lengths / lengths.sum())
+    with pysam.AlignmentFile(fileName, 'wb', header=header) as fo:
+        read = pysam.AlignedSegment(fo.header)
+        read.query_sequence = 'A' * readLength
+        read.query_qualities = pysam.qualitystring_to_array('C' * readLength)
+        read.cigarstring = '%iM' % readLength
+        for chrId, (chrom, n) in enumerate(zip(chroms, counts.tolist())):
+            length = genome[chrom]
+            mode = rng.choice(3, size=n, p=[0.6, 0.3, 0.1])
+            sizes = np.where(mode == 0,
+                             30 + rng.exponential(60, size=n),
+                             rng.normal(200 * mode, 30, size=n))
+            sizes = np.clip(sizes, readLength, 1000).astype(np.int64)
+            peaks = rng.integers(0, length, size=max(1, length // peakSpacing))
+            centers = np.where(rng.random(n) < fractionInPeaks,
+                               rng.choice(peaks, size=n) +
+                               rng.normal(0, 150, size=n),
+                               rng.integers(0, length, size=n))
+            starts = np.clip(centers - sizes // 2, 0,
+                             length - sizes).astype(np.int64)
+            flags = np.where(rng.random(n) < 0.05, 1024, 0)
+            mapqs = np.where(rng.random(n) < 0.9, 60,
+                             rng.integers(0, 30, size=n))
+            # Each fragment gives a forward read at its start
+            # and a reverse read at its end
+            readStarts = np.concatenate((starts, starts + sizes - readLength))
+            order = np.argsort(readStarts, kind='stable')
+            for j in order.tolist():
+                i = j % n
+                isFirst = j < n
+                read.query_name = 'ATAC.%s.%i' % (chrom, i)
+                read.flag = 1 + 2 + int(flags[i]) + \
+                    (64 + 32 if isFirst else 128 + 16)
+                read.reference_id = chrId
+                read.reference_start = int(readStarts[j])
+                read.mapping_quality = int(mapqs[i])
+                read.next_reference_id = chrId
+                read.next_reference_start = \
+                    int(readStarts[j + n if isFirst else j - n])
+                size = int(sizes[i])
+                read.template_length = size if isFirst else -size
+                read.set_tag('MQ', int(mapqs[i]))
+                fo.write(read)
+    pysam.index(fileName)
+
+
+def writeGtf(fileName, genome, nGenes, rng):
+    """ Write a gzipped gtf like the Ensembl ones with nGenes genes with
+    1 to 5 transcripts sharing some exons (which can have alternative ends).
+    60% of the transcripts are coding (with CDS, start and stop codons),
+    some genes and transcripts have no name.
+    Chromosomes are named without 'chr' like in Ensembl."""
+    chroms = list(genome)
+    lengths = np.array([genome[chrom] for chrom in chroms], dtype=np.float64)
+    counts = rng.multinomial(nGenes, lengths / lengths.sum())
+    geneIndex = 0
+    lines = []
+
+    def attributes(values):
+        return " ".join('%s "%s";' % (key, value) for key, value in values)
+
+    def line(chrom, feature, start, end, strand, values, frame='.'):
+        lines.append("%s\tsynthetic\t%s\t%i\t%i\t.\t%s\t%s\t%s\n"
+                     % (chrom, feature, start, end, strand, frame,
+                        attributes(values)))
+
+    with gzip.open(fileName, 'wt') as fo:
+        fo.write("#!genome-build synthetic\n")
+        for chrom, n in zip(chroms, counts.tolist()):
+            name = chrom[3:]
+            geneStarts = np.sort(rng.integers(1, genome[chrom] - 200000,
+                                              size=n))
+            for geneStart in geneStarts.tolist():
+                geneIndex += 1
+                geneId = 'SYNG%011i' % geneIndex
+                strand = '+' if rng.random() < 0.5 else '-'
+                nExons = int(rng.integers(1, 16))
+                exonLengths = rng.integers(50, 400, size=nExons)
+                introns = rng.integers(100, 10000, size=nExons)
+                exonStarts = geneStart + np.concatenate(
+                    ([0], np.cumsum(exonLengths + introns)[:-1]))
+                exonEnds = exonStarts + exonLengths - 1
+                geneValues = [('gene_id', geneId), ('gene_version', '1')]
+                if rng.random() < 0.95:
+                    geneValues.append(('gene_name', 'SYN%i' % geneIndex))
+                geneValues.append(('gene_biotype', 'protein_coding'))
+                transcripts = []
+                for t in range(int(rng.integers(1, 6))):
+                    chosen = np.flatnonzero(rng.random(nExons) < 0.8)
+                    if len(chosen) == 0:
+                        chosen = np.array([0])
+                    starts = exonStarts[chosen].copy()
+                    ends = exonEnds[chosen].copy()
+                    # Alternative ends of exons
+                    shift = rng.integers(-40, 40, size=len(chosen))
+                    ends = np.where(rng.random(len(chosen)) < 0.2,
+                                    np.maximum(ends + shift, starts), ends)
+                    transcripts.append((t, starts, ends))
+                line(name, 'gene',
+                     min(int(starts[0]) for _, starts, _ in transcripts),
+                     max(int(ends[-1]) for _, _, ends in transcripts),
+                     strand, geneValues)
+                for t, starts, ends in transcripts:
+                    trId = 'SYNT%011i' % (geneIndex * 10 + t)
+                    trValues = geneValues[:2] + \
+                        [('transcript_id', trId),
+                         ('transcript_version', '1')] + geneValues[2:]
+                    if rng.random() < 0.9:
+                        trValues.append(('transcript_name',
+                                         'SYN%i-%i' % (geneIndex, 201 + t)))
+                    line(name, 'transcript', int(starts[0]), int(ends[-1]),
+                         strand, trValues)
+                    order = range(len(starts))
+                    if strand == '-':
+                        order = reversed(order)
+                    isCoding = rng.random() < 0.6
+                    cdsStart = int(starts[0]) + 20
+                    cdsEnd = int(ends[-1]) - 20
+                    for number, e in enumerate(order):
+                        exonValues = trValues + \
+                            [('exon_number', str(number + 1)),
+                             ('exon_id', '%sE%i' % (trId, e))]
+                        start, end = int(starts[e]), int(ends[e])
+                        line(name, 'exon', start, end, strand, exonValues)
+                        if isCoding and start <= cdsEnd and end >= cdsStart:
+                            line(name, 'CDS', max(start, cdsStart),
+                                 min(end, cdsEnd), strand, exonValues, '0')
+                    if isCoding and cdsEnd - cdsStart > 6:
+                        first, last = cdsStart, cdsEnd - 2
+                        if strand == '-':
+                            first, last = last, first
+                        line(name, 'start_codon', first, first + 2, strand,
+                             trValues, '0')
+                        line(name, 'stop_codon', last, last + 2, strand,
+                             trValues, '0')
+                fo.write("".join(lines))
+                lines = []
+
+
+def generateData(outputDir, chromosomes=3, genomeSize=30000000,
+                 pairs=100000, atacFragments=100000, genes=300,
+                 siteSpacing=4096, seed=0):
+    """ Write the synthetic inputs in outputDir (the files which already
+    exist are reused, the parameters are in their names) and return
+    a dictionary with their paths:
+    digest, hicupBam, atacBam and gtf"""
+    os.makedirs(outputDir, exist_ok=True)
+    genome = makeGenome(chromosomes, genomeSize)
+    prefix = os.path.join(outputDir, 'synthetic_%ichr_%ibp_seed%i'
+                          % (chromosomes, genomeSize, seed))
+    paths = {'digest': '%s_digest%i.txt' % (prefix, siteSpacing),
+             'hicupBam': '%s_digest%i_%ipairs.hicup.bam'
+                         % (prefix, siteSpacing, pairs),
+             'atacBam': '%s_%ifragments.atac.bam' % (prefix, atacFragments),
+             'gtf': '%s_%igenes.gtf.gz' % (prefix, genes)}
+    # Each file has its own random generator
+    # so it does not depend on the other files
+    if not os.path.exists(paths['digest']) or \
+       not os.path.exists(paths['hicupBam']):
+        sites = makeRestrictionSites(genome, siteSpacing,
+                                     np.random.default_rng(seed))
+        if not os.path.exists(paths['digest']):
+            writeDigest(paths['digest'] + '.tmp', genome, sites)
+            os.rename(paths['digest'] + '.tmp', paths['digest'])
+        if not os.path.exists(paths['hicupBam']):
+            writeHicupBam(paths['hicupBam'] + '.tmp', genome, sites, pairs,
+                          np.random.default_rng(seed + 1))
+            os.rename(paths['hicupBam'] + '.tmp', paths['hicupBam'])
+    if not os.path.exists(paths['atacBam']):
+        writeAtacBam(paths['atacBam'], genome, atacFragments,
+                     np.random.default_rng(seed + 2))
+    if not os.path.exists(paths['gtf']):
+        writeGtf(paths['gtf'] + '.tmp', genome, genes,
+                 np.random.default_rng(seed + 3))
+        os.rename(paths['gtf'] + '.tmp', paths['gtf'])
+    return paths
+
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(
+        description=("Generate synthetic inputs for the benchmarks:"
+                     " a restriction digest (hicup_digester format),"
+                     " a bam with Hi-C pairs like hicup output,"
+                     " a coordinate-sorted ATAC-seq bam and a gtf."))
+    argp.add_argument('--outputDir', default='benchmark_data',
+                      help="Directory where the files are written.")
+    argp.add_argument('--chromosomes', default=3, type=int,
+                      help="Number of chromosomes.")
+    argp.add_argument('--genomeSize', default=30000000, type=int,
+                      help="Total length of the chromosomes.")
+    argp.add_argument('--pairs', default=100000, type=int,
+                      help="Number of Hi-C pairs.")
+    argp.add_argument('--atacFragments', default=100000, type=int,
+                      help="Number of ATAC-seq fragments (2 reads each).")
+    argp.add_argument('--genes', default=300, type=int,
+                      help="Number of genes in the gtf.")
+    argp.add_argument('--siteSpacing', default=4096, type=int,
+                      help=("Mean distance between 2 restriction sites"
+                            " (4096 for a 6 bp cutter)."))
+    argp.add_argument('--seed', default=0, type=int)
+    args = argp.parse_args()
+    paths = generateData(args.outputDir, args.chromosomes, args.genomeSize,
+                         args.pairs, args.atacFragments, args.genes,
+                         args.siteSpacing, args.seed)
+    for key, path in paths.items():
+        print("%s\t%s" % (key, path))
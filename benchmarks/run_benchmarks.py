@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import pstats
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_data import generateData
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+toolsDir = os.path.join(os.path.dirname(benchmarkDir), 'tools')
+
+# Parameters of generateData for each scale
+scales = {'small': {'chromosomes': 3, 'genomeSize': 30000000,
+                    'pairs': 100000, 'atacFragments': 100000,
+                    'genes': 300},
+          'medium': {'chromosomes': 10, 'genomeSize': 300000000,
+                     'pairs': 1000000, 'atacFragments': 1000000,
+                     'genes': 3000},
+          'large': {'chromosomes': 24, 'genomeSize': 3000000000,
+                    'pairs': 10000000, 'atacFragments': 10000000,
+                    'genes': 20000}}
+
+
+def toolScript(tool):
+    return os.path.join(toolsDir, tool, tool + '.py')
+
+
+def getBenchmarks(data, outDir, threads):
+    """ Return the benchmarks as (name, script, arguments)"""
+    threadOptions = [] if threads <= 1 else ['--threads', str(threads)]
+    hicup = [data['hicupBam'], '--fragmentFile', data['digest'],
+             '--lineToSkipInFragmentFile', '2']
+    atac = ['--input', data['atacBam'], '--length', '20']
+    return [
+        ('fromHicupToJuicebox_juicer', toolScript('fromHicupToJuicebox'),
+         hicup + threadOptions +
+         ['--output', os.path.join(outDir, 'validPairs.txt')]),
+        ('fromHicupToJuicebox_sorted', toolScript('fromHicupToJuicebox'),
+         hicup + threadOptions +
+         ['--sortOutput', '--output', os.path.join(outDir, 'sorted.txt')]),
+        ('fromHicupToJuicebox_cool', toolScript('fromHicupToJuicebox'),
+         hicup + threadOptions +
+         ['--outputFormat', 'cool', '--binSize', '100000',
+          '--output', os.path.join(outDir, 'pairs.cool')]),
+        ('getTn5ExtendedCoverage_bedgraph',
+         toolScript('getTn5ExtendedCoverage'),
+         atac + threadOptions +
+         ['--output', os.path.join(outDir, 'coverage.bedGraph')]),
+        ('getTn5ExtendedCoverage_bigwig',
+         toolScript('getTn5ExtendedCoverage'),
+         atac + threadOptions +
+         ['--outputFormat', 'bigwig',
+          '--output', os.path.join(outDir, 'coverage.bw')]),
+        ('getTn5ExtendedCoverage_pairedFragments_CPM',
+         toolScript('getTn5ExtendedCoverage'),
+         atac + threadOptions +
+         ['--excludeFlags', '1804', '--minMAPQ', '30', '--pairedFragments',
+          '--normalization', 'CPM',
+          '--output', os.path.join(outDir, 'coverage_CPM.bedGraph')]),
+        ('fromgtfTobed12_transcripts', toolScript('fromgtfTobed12'),
+         [data['gtf'], '--output', os.path.join(outDir, 'transcripts.bed')]),
+        ('fromgtfTobed12_mergeTranscripts', toolScript('fromgtfTobed12'),
+         [data['gtf'], '--mergeTranscripts',
+          '--output', os.path.join(outDir, 'genes.bed')]),
+        ('fromgtfTobed12_mergeTranscriptsAndOverlappingExons',
+         toolScript('fromgtfTobed12'),
+         [data['gtf'], '--mergeTranscriptsAndOverlappingExons',
+          '--output', os.path.join(outDir, 'genesMergedExons.bed')])]
+
+
+def runCommand(command, logFile):
+    """ Run the command with its stdout and stderr in logFile.
+    Return the return code, the wall time in seconds and the peak RSS in MB
+    (of the process and of its children which were waited for)"""
+    with open(logFile, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+        wallTime = time.perf_counter() - start
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    if sys.platform == 'darwin':
+        peakRSS = usage.ru_maxrss / 1024 / 1024
+    else:
+        peakRSS = usage.ru_maxrss / 1024
+    if os.WIFSIGNALED(status):
+        returnCode = -os.WTERMSIG(status)
+    else:
+        returnCode = os.WEXITSTATUS(status)
+    return returnCode, wallTime, peakRSS
+
+
+def withoutThreads(arguments):
+    """ Return the arguments without the --threads option"""
+    if '--threads' not in arguments:
+        return arguments
+    i = arguments.index('--threads')
+    return arguments[:i] + arguments[i + 2:]
+
+
+def profileFunctions(script, arguments, profileFile, logFile, top):
+    """ Run the script with cProfile and return the return code and
+    the time spent in the top functions of the script (by cumulative time)
+    as a dictionary name:line -> calls, own time and cumulative time in
+    seconds (None if the run failed).
+    The script is run in a single process: under cProfile the script is
+    __main__ and its functions cannot be sent to worker processes."""
+    command = [sys.executable, '-m', 'cProfile', '-o', profileFile,
+               script] + withoutThreads(arguments)
+    returnCode, _, _ = runCommand(command, logFile)
+    if returnCode != 0 or not os.path.exists(profileFile):
+        return returnCode, None
+    stats = pstats.Stats(profileFile).stats
+    functions = [(cumulativeTime, '%s:%i' % (name, line),
+                  {'calls': calls, 'ownTime': round(ownTime, 4),
+                   'cumulativeTime': round(cumulativeTime, 4)})
+                 for (fileName, line, name),
+                 (_, calls, ownTime, cumulativeTime, _) in stats.items()
+                 if os.path.abspath(fileName) == script and name != '<module>']
+    functions.sort(key=lambda function: function[0], reverse=True)
+    return returnCode, {name: values
+                        for _, name, values in functions[:top]}
+
+
+def gitCommit():
+    """ Return the commit of the tools and if they have local changes"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=toolsDir,
+            stderr=subprocess.DEVNULL).decode().strip()
+        changes = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--', '.'], cwd=toolsDir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, changes != ''
+
+
+def runBenchmarks(benchmarks, outDir, repeat, profile, top):
+    """ Run each benchmark repeat times (and once with cProfile if profile)
+    and return the results as a list of dictionaries"""
+    results = []
+    for name, script, arguments in benchmarks:
+        print("Running %s..." % name, file=sys.stderr)
+        logFile = os.path.join(outDir, name + '.log')
+        result = {'name': name,
+                  'command': [os.path.relpath(script, toolsDir)] + arguments,
+                  'wallTimes': [], 'peakRSS_MB': 0}
+        for _ in range(repeat):
+            returnCode, wallTime, peakRSS = \
+                runCommand([sys.executable, script] + arguments, logFile)
+            result['returnCode'] = returnCode
+            if returnCode != 0:
+                with open(logFile, 'r') as f:
+                    result['error'] = f.read()[-2000:]
+                print("%s failed (return code %i)" % (name, returnCode),
+                      file=sys.stderr)
+                break
+            result['wallTimes'].append(round(wallTime, 4))
+            result['peakRSS_MB'] = round(max(result['peakRSS_MB'], peakRSS),
+                                         1)
+        if len(result['wallTimes']) > 0:
+            times = sorted(result['wallTimes'])
+            result['bestWallTime'] = times[0]
+            result['medianWallTime'] = times[len(times) // 2]
+            print("%s: %.3f s, %.1f MB" % (name, result['bestWallTime'],
+                                           result['peakRSS_MB']),
+                  file=sys.stderr)
+            if profile:
+                profileLogFile = os.path.join(outDir, name + '_profile.log')
+                returnCode, result['functions'] = profileFunctions(
+                    script, arguments, os.path.join(outDir, name + '.prof'),
+                    profileLogFile, top)
+                if result['functions'] is None:
+                    result['profileReturnCode'] = returnCode
+                    with open(profileLogFile, 'r') as f:
+                        result['profileError'] = f.read()[-2000:]
+                    print("Profiling of %s failed (return code %i):\n%s"
+                          % (name, returnCode, result['profileError']),
+                          file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def compareResults(baselineFile, results, fo):
+    """ Write a table comparing the best wall times and peak RSS
+    of the results with the ones of the baselineFile"""
+    with open(baselineFile, 'r') as f:
+        baseline = json.load(f)
+    previous = {result['name']: result for result in baseline['benchmarks']}
+    fo.write("Comparison with %s (commit %s)\n"
+             % (baselineFile, baseline.get('commit')))
+    fo.write("%-52s %10s %10s %7s %10s %10s\n"
+             % ('benchmark', 'before(s)', 'after(s)', 'speedup',
+                'before(MB)', 'after(MB)'))
+    for result in results:
+        before = previous.get(result['name'], {})
+        if 'bestWallTime' not in before or 'bestWallTime' not in result:
+            fo.write("%-52s %10s %10s\n"
+                     % (result['name'],
+                        before.get('bestWallTime', 'NA'),
+                        result.get('bestWallTime', 'NA')))
+            continue
+        fo.write("%-52s %10.3f %10.3f %6.2fx %10.1f %10.1f\n"
+                 % (result['name'], before['bestWallTime'],
+                    result['bestWallTime'],
+                    before['bestWallTime'] / result['bestWallTime'],
+                    before['peakRSS_MB'], result['peakRSS_MB']))
+
+
+argp = argparse.ArgumentParser(
+    description=("Benchmark fromHicupToJuicebox, getTn5ExtendedCoverage and"
+                 " fromgtfTobed12 on synthetic data: wall time, peak RSS"
+                 " and time per function, written as json to compare"
+                 " commits."))
+argp.add_argument('--scale', default='small', choices=list(scales),
+                  help=("Size of the synthetic data (see scales, each"
+                        " parameter can be changed with the options below)."))
+argp.add_argument('--chromosomes', default=None, type=int)
+argp.add_argument('--genomeSize', default=None, type=int)
+argp.add_argument('--pairs', default=None, type=int,
+                  help="Number of Hi-C pairs.")
+argp.add_argument('--atacFragments', default=None, type=int,
+                  help="Number of ATAC-seq fragments.")
+argp.add_argument('--genes', default=None, type=int,
+                  help="Number of genes in the gtf.")
+argp.add_argument('--seed', default=0, type=int)
+argp.add_argument('--dataDir', default='benchmark_data',
+                  help=("Directory with the synthetic data"
+                        " (generated if missing)."))
+argp.add_argument('--output', default=None,
+                  help=("Json file with the results"
+                        " (default is benchmark_<commit>_<scale>.json)."))
+argp.add_argument('--compare', default=None,
+                  help="Json file of a previous run to compare with.")
+argp.add_argument('--benchmarks', default=None,
+                  help="Regular expression to select the benchmarks to run.")
+argp.add_argument('--repeat', default=3, type=int,
+                  help="Number of runs of each benchmark.")
+argp.add_argument('--threads', default=1, type=int,
+                  help="Value of --threads given to the tools.")
+argp.add_argument('--noProfile', action='store_true',
+                  help="Do not measure the time spent in each function.")
+argp.add_argument('--topFunctions', default=20, type=int,
+                  help="Number of functions reported for each benchmark.")
+argp.add_argument('--keepOutputs', default=None,
+                  help="Directory where the outputs of the tools are kept.")
+args = argp.parse_args()
+parameters = dict(scales[args.scale])
+for key in parameters:
+    if getattr(args, key) is not None:
+        parameters[key] = getattr(args, key)
+parameters['seed'] = args.seed
+print("Generating data...", file=sys.stderr)
+data = generateData(args.dataDir, **parameters)
+if args.keepOutputs is None:
+    outDir = tempfile.mkdtemp()
+else:
+    outDir = args.keepOutputs
+    os.makedirs(outDir, exist_ok=True)
+benchmarks = getBenchmarks(data, outDir, args.threads)
+if args.benchmarks is not None:
+    benchmarks = [benchmark for benchmark in benchmarks
+                  if re.search(args.benchmarks, benchmark[0])]
+commit, localChanges = gitCommit()
+try:
+    results = runBenchmarks(benchmarks, outDir, args.repeat,
+                            not args.noProfile, args.topFunctions)
+finally:
+    if args.keepOutputs is None:
+        shutil.rmtree(outDir, ignore_errors=True)
+report = {'commit': commit, 'localChanges': localChanges,
+          'date': datetime.datetime.now().isoformat(timespec='seconds'),
+          'python': platform.python_version(),
+          'platform': platform.platform(),
+          'cpus': os.cpu_count(),
+          'scale': args.scale, 'parameters': parameters,
+          'threads': args.threads, 'repeat': args.repeat,
+          'benchmarks': results}
+output = args.output
+if output is None:
+    output = 'benchmark_%s_%s.json' % ((commit or 'nocommit')[:7], args.scale)
+with open(output, 'w') as fo:
+    json.dump(report, fo, indent=2)
+print("Results written in " + output, file=sys.stderr)
+if args.compare is not None:
+    compareResults(args.compare, results, sys.stdout)
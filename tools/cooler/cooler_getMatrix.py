@@ -0,0 +1,429 @@
+import argparse
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+
+import cooler
+
+import numpy as np
+
+import pandas as pd
+
+import scipy.sparse
+
+# Maximum number of cells of a dense tile when --tileSize is not given
+maxTileCells = 10000000
+
+
+def checkInput(args):
+    if args.r2 is None:
+        args.r2 = args.r1
+
+
+def getExtent(c, r):
+    'First and last+1 bin ids of the region (the whole matrix if None)'
+    if r is None:
+        return 0, int(c.info['nbins'])
+    lo, hi = c.extent(r)
+    return int(lo), int(hi)
+
+
+def getHeaders(bins, a):
+    return (["%s|%s|%s:%i-%i" % (i, a, chromid, s, e)
+             for i, chromid, s, e in zip(bins.index, bins['chrom'],
+                                         bins['start'], bins['end'])])
+
+
+def getTiles(c, balance, rowExtent, colExtent, tileSize):
+    """Yield the first row of each tile of tileSize rows
+    (relative to rowExtent) and its values as a scipy coo_matrix.
+    Only the pixels of the tile are loaded (sparse fetch of cooler)."""
+    selector = c.matrix(balance=balance, sparse=True)
+    for start in range(rowExtent[0], rowExtent[1], tileSize):
+        end = min(start + tileSize, rowExtent[1])
+        yield (start - rowExtent[0],
+               selector[start:end, colExtent[0]:colExtent[1]])
+
+
+def getWeights(bins, balance):
+    'Weights of the bins if balance else None'
+    if balance:
+        return bins['weight'].values
+    return None
+
+
+def toDense(tile, rowWeights, colWeights, first):
+    """Dense values of the tile beginning at the row first like the dense
+    fetch of cooler: with balance, all values of bins without weight
+    are nan"""
+    block = tile.toarray()
+    if rowWeights is not None:
+        block[np.isnan(rowWeights[first:first + block.shape[0]]), :] = np.nan
+        block[:, np.isnan(colWeights)] = np.nan
+    return block
+
+
+def writeDense(f, c, balance, rowBins, colBins, rowExtent, colExtent,
+               tileSize, rowH=None, colH=None):
+    """Write the matrix as text by blocks of rows:
+    one format per row instead of one per value"""
+    rowWeights = getWeights(rowBins, balance)
+    colWeights = getWeights(colBins, balance)
+    rowFormat = '\t'.join(["%.6g"] * len(colBins)) + '\n'
+    if rowH is not None:
+        f.write("%ix%i" % (len(rowH), len(colH)) + '\t' + '\t'.join(colH)
+                + '\n')
+        rowFormat = '%s\t' + rowFormat
+    for first, tile in getTiles(c, balance, rowExtent, colExtent, tileSize):
+        block = toDense(tile, rowWeights, colWeights, first)
+        if rowH is None:
+            f.write(''.join([rowFormat % tuple(row)
+                             for row in block.tolist()]))
+        else:
+            f.write(''.join([rowFormat % tuple([rowH[first + i]] + row)
+                             for i, row in enumerate(block.tolist())]))
+
+
+def writeNpy(output, c, balance, rowBins, colBins, rowExtent, colExtent,
+             tileSize):
+    'Write the dense matrix in a .npy memory-mapped file tile by tile'
+    mat = np.lib.format.open_memmap(output, mode='w+', dtype=np.float64,
+                                    shape=(len(rowBins), len(colBins)))
+    rowWeights = getWeights(rowBins, balance)
+    colWeights = getWeights(colBins, balance)
+    for first, tile in getTiles(c, balance, rowExtent, colExtent, tileSize):
+        mat[first:first + tile.shape[0]] = toDense(tile, rowWeights,
+                                                   colWeights, first)
+    mat.flush()
+    del mat
+
+
+def writeNpz(output, c, balance, rowBins, colBins, rowExtent, colExtent,
+             tileSize):
+    """Write the non-zero values in a scipy sparse coo .npz
+    (rows and cols are relative to the regions,
+    it can be read with scipy.sparse.load_npz)"""
+    rows = []
+    cols = []
+    data = []
+    for first, tile in getTiles(c, balance, rowExtent, colExtent, tileSize):
+        rows.append(tile.row + first)
+        cols.append(tile.col)
+        data.append(tile.data)
+    mat = scipy.sparse.coo_matrix(
+        (np.concatenate(data) if len(data) > 0 else np.zeros(0),
+         (np.concatenate(rows) if len(rows) > 0 else np.zeros(0, dtype=int),
+          np.concatenate(cols) if len(cols) > 0 else np.zeros(0, dtype=int))),
+        shape=(len(rowBins), len(colBins)))
+    with open(output, 'wb') as f:
+        scipy.sparse.save_npz(f, mat)
+
+
+def writePixels(f, c, balance, rowBins, colBins, rowExtent, colExtent,
+                tileSize, header):
+    """Write the pixel table (chrom1 start1 end1 chrom2 start2 end2 count
+    and balanced with balance) by tiles.
+    All non-zero values of the matrix are written (both triangles of
+    symmetric regions, like the dense output)."""
+    rowWeights = getWeights(rowBins, balance)
+    colWeights = getWeights(colBins, balance)
+    for first, tile in getTiles(c, False, rowExtent, colExtent, tileSize):
+        # Pixels ordered by row then col
+        tile = tile.tocsr()
+        tile.sort_indices()
+        tile = tile.tocoo()
+        rows = rowBins.iloc[first + tile.row]
+        cols = colBins.iloc[tile.col]
+        pixels = pd.DataFrame({
+            'chrom1': rows['chrom'].values, 'start1': rows['start'].values,
+            'end1': rows['end'].values, 'chrom2': cols['chrom'].values,
+            'start2': cols['start'].values, 'end2': cols['end'].values,
+            'count': tile.data.astype(np.int64)})
+        if balance:
+            pixels['balanced'] = tile.data * \
+                rowWeights[first + tile.row] * colWeights[tile.col]
+        pixels.to_csv(f, sep='\t', header=header and first == 0,
+                      index=False, float_format="%.6g")
+
+
+class CoolerCache(object):
+    """The cooler with its bin table (and weights) read once
+    (when needed) and the headers of the bins computed once"""
+    def __init__(self, uri):
+        self.cooler = cooler.Cooler(uri)
+        self.bins = None
+        self.headers = None
+
+    def getExtent(self, r):
+        return getExtent(self.cooler, r)
+
+    def getBins(self, extent):
+        if self.bins is None:
+            self.bins = self.cooler.bins()[:]
+        return self.bins.iloc[extent[0]:extent[1]]
+
+    def getHeaders(self, extent):
+        if self.headers is None:
+            self.headers = getHeaders(self.getBins((0, None)),
+                                      self.cooler.info['genome-assembly'])
+        return self.headers[extent[0]:extent[1]]
+
+
+def getResolutions(path):
+    """Resolutions of a multi-resolution cooler (.mcool) in increasing
+    order or None if it is a single cooler"""
+    if not cooler.fileops.is_multires_file(path):
+        return None
+    return sorted(int(uri.split('/')[-1])
+                  for uri in cooler.fileops.list_coolers(path)
+                  if uri.startswith('/resolutions/'))
+
+
+class MultiResCache(object):
+    """The CoolerCache of each resolution used of a cool or mcool file.
+    For a mcool, the resolution is either fixed or the finest one
+    where the matrix has at most maxSize values
+    (the coarsest one if none)."""
+    def __init__(self, path, resolution=None, maxSize=None):
+        self.path = path
+        self.resolutions = getResolutions(path)
+        self.resolution = resolution
+        self.maxSize = maxSize
+        self.caches = {}
+        if self.resolutions is not None and resolution is not None and \
+           resolution not in self.resolutions:
+            raise Exception("The resolution %i is not in %s (%s)."
+                            % (resolution, path,
+                               ", ".join(str(res)
+                                         for res in self.resolutions)))
+
+    def getCacheOfResolution(self, resolution):
+        if resolution not in self.caches:
+            if resolution is None:
+                uri = self.path
+            else:
+                uri = "%s::resolutions/%i" % (self.path, resolution)
+            self.caches[resolution] = CoolerCache(uri)
+        return self.caches[resolution]
+
+    def getCache(self, r1, r2):
+        'The CoolerCache to use for the matrix r1 x r2'
+        if self.resolutions is None:
+            return self.getCacheOfResolution(None)
+        if self.resolution is not None:
+            return self.getCacheOfResolution(self.resolution)
+        for resolution in self.resolutions:
+            cache = self.getCacheOfResolution(resolution)
+            rowExtent = cache.getExtent(r1)
+            colExtent = cache.getExtent(r2)
+            if (rowExtent[1] - rowExtent[0]) * \
+               (colExtent[1] - colExtent[0]) <= self.maxSize:
+                break
+        return cache
+
+
+def extractRegion(caches, r1, r2, output, outputFormat, balance, header,
+                  tileSize=None):
+    """Write in output the matrix of r1 x r2
+    (regions as strings or (chrom, start, end))
+    at the resolution given by caches (a MultiResCache)"""
+    cache = caches.getCache(r1, r2)
+    coolerInput = cache.cooler
+    rowExtent = cache.getExtent(r1)
+    colExtent = cache.getExtent(r2)
+    rowBins = cache.getBins(rowExtent)
+    colBins = cache.getBins(colExtent)
+    if tileSize is None:
+        tileSize = max(1, maxTileCells // max(1, len(colBins)))
+    if outputFormat == 'npy':
+        writeNpy(output, coolerInput, balance, rowBins, colBins,
+                 rowExtent, colExtent, tileSize)
+    elif outputFormat == 'npz':
+        writeNpz(output, coolerInput, balance, rowBins, colBins,
+                 rowExtent, colExtent, tileSize)
+    elif outputFormat == 'pixels':
+        with open(output, 'w') as f:
+            writePixels(f, coolerInput, balance, rowBins, colBins,
+                        rowExtent, colExtent, tileSize, header)
+    elif header:
+        rowH = cache.getHeaders(rowExtent)
+        colH = cache.getHeaders(colExtent)
+        with open(output, 'w') as f:
+            writeDense(f, coolerInput, balance, rowBins, colBins,
+                       rowExtent, colExtent, tileSize, rowH, colH)
+    else:
+        with open(output, 'w') as f:
+            writeDense(f, coolerInput, balance, rowBins, colBins,
+                       rowExtent, colExtent, tileSize)
+
+
+def readRegions(regionFile):
+    """Return the list of (name, r1, r2) of a bed (r2 is r1)
+    or of a bedpe (chrom1 start1 end1 chrom2 start2 end2).
+    The regions are (chrom, start, end) 0-based half-open.
+    The name is the next column or chrom_start_end."""
+    regions = []
+    with open(regionFile, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if line.startswith('#') or line.startswith('track') or \
+               line.startswith('browser') or len(fields) < 3:
+                continue
+            r1 = (fields[0], int(fields[1]), int(fields[2]))
+            if len(fields) >= 6 and fields[4].isdigit() and \
+               fields[5].isdigit():
+                r2 = (fields[3], int(fields[4]), int(fields[5]))
+                nameField = 6
+                name = "%s_%i_%i-%s_%i_%i" % (r1 + r2)
+            else:
+                r2 = r1
+                nameField = 3
+                name = "%s_%i_%i" % r1
+            if len(fields) > nameField and fields[nameField] != '':
+                name = fields[nameField]
+            regions.append((name, r1, r2))
+    return regions
+
+
+def getRegionFileNames(regions, outputFormat):
+    'One file name per region (names are made unique)'
+    extension = {'dense': '.txt', 'pixels': '.txt', 'npy': '.npy',
+                 'npz': '.npz'}[outputFormat]
+    fileNames = []
+    used = set()
+    for name, _, _ in regions:
+        base = re.sub('[^A-Za-z0-9_.:+-]', '_', name).replace(':', '_')
+        fileName = base + extension
+        i = 1
+        while fileName in used:
+            i += 1
+            fileName = "%s_%i%s" % (base, i, extension)
+        used.add(fileName)
+        fileNames.append(fileName)
+    return fileNames
+
+
+# Cooler of the worker processes of extractRegions
+workerCache = None
+
+
+def initWorker(path, resolution=None, maxSize=None):
+    global workerCache
+    workerCache = MultiResCache(path, resolution, maxSize)
+
+
+def extractRegionTask(params):
+    r1, r2, output, outputFormat, balance, header, tileSize = params
+    extractRegion(workerCache, r1, r2, output, outputFormat, balance,
+                  header, tileSize)
+    return output
+
+
+def extractRegions(path, regions, output, outputFormat, balance, header,
+                   tileSize=None, threads=1, combined=False,
+                   resolution=None, maxSize=None):
+    """Write the matrix of each region (see readRegions) in the directory
+    output or, if combined, in the zip archive output.
+    The cooler is opened and the bin table is read once per process.
+    With threads > 1, the regions are extracted in parallel."""
+    fileNames = getRegionFileNames(regions, outputFormat)
+    if combined:
+        outDir = tempfile.mkdtemp()
+    else:
+        outDir = output
+        os.makedirs(outDir, exist_ok=True)
+    tasks = [(r1, r2, os.path.join(outDir, fileName), outputFormat,
+              balance, header, tileSize)
+             for (_, r1, r2), fileName in zip(regions, fileNames)]
+    pool = None
+    try:
+        if threads <= 1:
+            initWorker(path, resolution, maxSize)
+            results = map(extractRegionTask, tasks)
+        else:
+            pool = multiprocessing.Pool(threads, initWorker,
+                                        (path, resolution, maxSize))
+            # The order of the regions is kept in the archive
+            results = pool.imap(extractRegionTask, tasks)
+        if combined:
+            # npy and npz are already compressed or binary
+            compression = zipfile.ZIP_DEFLATED \
+                if outputFormat in ['dense', 'pixels'] else zipfile.ZIP_STORED
+            with zipfile.ZipFile(output, 'w', compression,
+                                 allowZip64=True) as archive:
+                for regionFile in results:
+                    archive.write(regionFile, os.path.basename(regionFile))
+                    os.remove(regionFile)
+        else:
+            for _ in results:
+                pass
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if combined:
+            shutil.rmtree(outDir, ignore_errors=True)
+
+
+argp = argparse.ArgumentParser(
+    description='Extract a matrix from a cool file.')
+argp.add_argument('--input', default=None,
+                  help='a cool (or mcool) file to extract from.')
+argp.add_argument('--output', default=None,
+                  help=("a txt file with matrix values (with --regions,"
+                        " a directory or a zip archive with --combined)."))
+argp.add_argument('--outputFormat', default='dense',
+                  choices=['dense', 'pixels', 'npy', 'npz'],
+                  help=("dense is a tabulated matrix, pixels a table with"
+                        " one line per non-zero value, npy the dense matrix"
+                        " in numpy format and npz the non-zero values in"
+                        " scipy sparse format."))
+argp.add_argument('--header', action="store_true",
+                  help=("If you want to print row names and col names"
+                        " (by default there are only values)."))
+argp.add_argument('--balance', action="store_true",
+                  help=("If you want the balanced values"
+                        " (by default it is the raw)."))
+argp.add_argument('--r1', default=None,
+                  help='the region 1 on which you should generate the matrix')
+argp.add_argument('--r2', default=None,
+                  help='the region 2 if different from region1.')
+argp.add_argument('--tileSize', default=None, type=int,
+                  help=("Number of rows fetched at once (by default a dense"
+                        " tile has at most %i values)." % maxTileCells))
+
+argp.add_argument('--regions', default=None,
+                  help=("a bed (or bedpe with pairs of regions) with one"
+                        " region per line: the matrix of each region is"
+                        " written in --output named by the name column"
+                        " (or chrom_start_end)."))
+argp.add_argument('--combined', action="store_true",
+                  help=("With --regions, write all matrices in the zip"
+                        " archive --output."))
+argp.add_argument('--threads', default=1, type=int,
+                  help="With --regions, number of regions extracted"
+                       " in parallel.")
+argp.add_argument('--resolution', default=None, type=int,
+                  help="With a mcool, the resolution to use.")
+argp.add_argument('--maxSize', default=None, type=int,
+                  help=("With a mcool, use the finest resolution where the"
+                        " matrix has at most maxSize values (the coarsest"
+                        " one if none)."))
+
+args = argp.parse_args()
+checkInput(args)
+if getResolutions(args.input) is not None and \
+   (args.resolution is None) == (args.maxSize is None):
+    argp.error("A mcool needs --resolution or --maxSize.")
+if args.regions is None:
+    extractRegion(MultiResCache(args.input, args.resolution, args.maxSize),
+                  args.r1, args.r2, args.output, args.outputFormat,
+                  args.balance, args.header, args.tileSize)
+else:
+    extractRegions(args.input, readRegions(args.regions), args.output,
+                   args.outputFormat, args.balance, args.header,
+                   args.tileSize, args.threads, args.combined,
+                   args.resolution, args.maxSize)
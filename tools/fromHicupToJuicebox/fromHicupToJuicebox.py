@@ -1,17 +1,56 @@
 from __future__ import print_function
 
 import argparse
-import bisect
+import array
+import collections
+import contextlib
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
 import os
-import subprocess
+import pickle
+import re
+import shutil
+import struct
 import sys
 import tempfile
+import time
+import zlib
 from signal import SIGPIPE, SIG_DFL, signal
 
+import numpy as np
+
 import pysam
 
 signal(SIGPIPE, SIG_DFL)
 
+# Number of reads processed at once
+batchSize = 200000
+# Format of a line of the validpair file
+pairFormat = "%s\t%i\t%s\t%i\t%i\t%i\t%s\t%i\t%i\t%i\t%i\n"
+# Format of a line of the .pairs file
+pairsFormat = "%s\t%s\t%i\t%s\t%i\t%s\t%s\t%i\t%i\t%i\t%i\n"
+# Number of pairs binned at once for the cool output
+coolChunkSize = 10000000
+# Approximative memory used by a pair in addition to its line while sorting
+recordOverhead = 300
+# Number of pairs pickled together in the sorted runs
+runBlockSize = 10000
+# Maximum number of sorted runs merged at once
+maxOpenRuns = 256
+# Number of reads used to estimate the compressed size of a read
+# when the bam is split in chunks
+chunkSampleReads = 100000
+# Header of a BGZF block (gzip with the BC extra field)
+bgzfMagic = b'\x1f\x8b\x08\x04'
+# Fields of a bam record until the read name
+bamRecordHeader = struct.Struct('<iiiBBHHHiiii')
+# Fields which are compared as numbers by awk
+awkNumber = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -33,20 +72,26 @@ class InputError(Error):
         return self.expr+"\n"+self.msg
 
 
-def find_FragAndMid(chrBiDic, x):
-    'Find fragID and midPosition value for the x coordinates'
-    i = bisect.bisect_left(chrBiDic['starts'], x)
-    if i:
-        currentStart = chrBiDic['starts'][i-1]
-        return(chrBiDic['dic'][str(currentStart)])
-    raise ValueError
+def find_FragAndMid(chrFrags, positions):
+    """Find fragIDs and midPosition values for an array of x coordinates.
+    The fragment of x is the last fragment which starts strictly before x.
+    Also return which positions have a fragment
+    (the others are before the first fragment)."""
+    i = np.searchsorted(chrFrags['starts'], positions, side='left')
+    found = i > 0
+    i = np.maximum(i - 1, 0)
+    return chrFrags['ids'][i], chrFrags['mids'][i], found
 
 
 def loadFragFile(fragmentFile, colC, colS, colE, colI, headerSize):
+    """Return a dictionary where keys are chromosomes and values are
+    dictionaries with 3 numpy arrays:
+    'starts' (sorted as in the fragment file), 'ids' and 'mids'."""
     dicFragIDStart = {}
     currentChr = ""
-    currentListOfStarts = []
-    currentDic = {}
+    currentStarts = array.array('q')
+    currentIDs = array.array('q')
+    currentMids = array.array('q')
     with open(fragmentFile, 'r') as f:
         for i, line in enumerate(f):
             if(i < headerSize):
@@ -58,30 +103,1023 @@ def loadFragFile(fragmentFile, colC, colS, colE, colI, headerSize):
                                " with the line :\n")
                 raise InputError("len(v) < max(colC, colS, colE, colI)",
                                  stringError + line)
-            if(v[colC] == currentChr):
-                currentListOfStarts.append(int(v[colS]))
-            else:
-                dicFragIDStart[currentChr] = {'starts': currentListOfStarts,
-                                              'dic': currentDic}
+            if(v[colC] != currentChr):
+                dicFragIDStart[currentChr] = \
+                    fragArrays(currentStarts, currentIDs, currentMids)
                 currentChr = v[colC]
-                currentListOfStarts = [int(v[colS])]
-                currentDic = {}
-            currentDic[v[colS]] = [int(v[colI]),
-                                   int((int(v[colE])+int(v[colS]))/2)]
-    dicFragIDStart[currentChr] = {'starts': currentListOfStarts,
-                                  'dic': currentDic}
+                currentStarts = array.array('q')
+                currentIDs = array.array('q')
+                currentMids = array.array('q')
+            start = int(v[colS])
+            currentStarts.append(start)
+            currentIDs.append(int(v[colI]))
+            currentMids.append((int(v[colE]) + start) // 2)
+    dicFragIDStart[currentChr] = fragArrays(currentStarts, currentIDs,
+                                            currentMids)
     return(dicFragIDStart)
 
 
-def fiveP_oneB_read_start(read):
-    if read.is_reverse:
-        return read.reference_end
-    else:
-        return read.reference_start + 1
+def fragArrays(starts, ids, mids):
+    'Convert the arrays of a chromosome to numpy arrays'
+    return {'starts': np.frombuffer(starts, dtype=np.int64),
+            'ids': np.frombuffer(ids, dtype=np.int64),
+            'mids': np.frombuffer(mids, dtype=np.int64)}
+
+
+def fragmentFileKey(fragmentFile, colC, colS, colE, colI, headerSize):
+    'Key of the fragment file in the cache (content and arguments)'
+    h = hashlib.sha256()
+    with open(fragmentFile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(("%i\t%i\t%i\t%i\t%i"
+              % (colC, colS, colE, colI, headerSize)).encode())
+    return h.hexdigest()
+
+
+def writeFragCache(bigDic, entryDir):
+    """Write the fragment arrays of all chromosomes
+    concatenated in entryDir as .npy files"""
+    chroms = list(bigDic.keys())
+    offsets = np.cumsum([0] + [len(bigDic[c]['starts']) for c in chroms])
+    np.save(os.path.join(entryDir, 'chroms.npy'), np.array(chroms))
+    np.save(os.path.join(entryDir, 'offsets.npy'), offsets)
+    for k in ['starts', 'ids', 'mids']:
+        np.save(os.path.join(entryDir, k + '.npy'),
+                np.concatenate([bigDic[c][k] for c in chroms]))
+
+
+def readFragCache(entryDir):
+    'Memory-map the arrays of the cache entry and split them by chromosome'
+    chroms = np.load(os.path.join(entryDir, 'chroms.npy'))
+    offsets = np.load(os.path.join(entryDir, 'offsets.npy'))
+    arrays = {k: np.load(os.path.join(entryDir, k + '.npy'), mmap_mode='r')
+              for k in ['starts', 'ids', 'mids']}
+    return {str(c): {k: arrays[k][offsets[i]:offsets[i + 1]]
+                     for k in arrays}
+            for i, c in enumerate(chroms)}
+
+
+def evictFragCache(cacheDir, maxSize, keep):
+    """Remove the least recently used entries of cacheDir
+    until its size is below maxSize (in bytes). keep is never removed."""
+    entries = []
+    for name in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, name)
+        if name.startswith('.') or not os.path.isdir(entryDir):
+            continue
+        size = sum(os.path.getsize(os.path.join(entryDir, f))
+                   for f in os.listdir(entryDir))
+        entries.append((os.path.getmtime(entryDir), size, entryDir))
+    totalSize = sum(e[1] for e in entries)
+    for _, size, entryDir in sorted(entries):
+        if totalSize <= maxSize:
+            break
+        if entryDir == keep:
+            continue
+        shutil.rmtree(entryDir, ignore_errors=True)
+        totalSize -= size
+
+
+def loadFragFileWithCache(fragmentFile, colC, colS, colE, colI, headerSize,
+                          cacheDir, maxCacheSize):
+    """Same as loadFragFile but the parsed arrays are stored in cacheDir
+    and memory-mapped from there when the same fragment file is used
+    with the same arguments."""
+    entryDir = os.path.join(cacheDir, fragmentFileKey(fragmentFile, colC,
+                                                      colS, colE, colI,
+                                                      headerSize))
+    if os.path.isdir(entryDir):
+        print("Using the cached fragment file " + entryDir, file=sys.stderr)
+        # Update the time of last use
+        os.utime(entryDir)
+        return readFragCache(entryDir)
+    bigDic = loadFragFile(fragmentFile, colC, colS, colE, colI, headerSize)
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    # The entry is written in a temporary directory
+    # so other jobs never see an incomplete entry
+    tmpEntryDir = tempfile.mkdtemp(dir=cacheDir, prefix='.tmp')
+    writeFragCache(bigDic, tmpEntryDir)
+    try:
+        os.rename(tmpEntryDir, entryDir)
+    except OSError:
+        # Another job stored the same entry in the meantime
+        shutil.rmtree(tmpEntryDir, ignore_errors=True)
+    evictFragCache(cacheDir, maxCacheSize, entryDir)
+    return readFragCache(entryDir)
+
+
+def fiveP_oneB_read_start(starts, ends, strands):
+    'One-based 5\' positions of the reads'
+    return np.where(strands == 1, ends, starts + 1)
+
+
+def lookupPosition(starts, ends, strands, method):
+    'Positions used to find the fragment of the reads'
+    if method == 'hicup':
+        # this bowtie+10 is to follow hicup_filter <= 6.1.0
+        return starts + 1 + 10
+    elif method == 'hiclib':
+        return np.where(strands == 1, ends - 4, starts + 1 + 4)
+
+
+def repairHicupHeader(headerText):
+    """With HiCUP v0.6.1 the header is malformated:
+    @PG     ID:HiCUP Filter VN:0.6.1        DS:"Max insert 0 Min insert..."
+    @PG     HiCUP Deduplicator      VN:0.6.1
+    So the ID: tag is added to @PG lines which miss it."""
+    lines = []
+    for line in headerText.splitlines():
+        fields = line.split('\t')
+        if fields[0] == '@PG' and len(fields) > 1 and \
+           not any(f.startswith('ID:') for f in fields[1:]) and \
+           re.match('^[A-Za-z][A-Za-z0-9]:', fields[1]) is None:
+            fields[1] = 'ID:' + fields[1]
+        lines.append('\t'.join(fields))
+    return '\n'.join(lines) + '\n'
+
+
+class SamTextWithRepairedHeader(object):
+    """Minimal replacement of pysam.AlignmentFile for sam files
+    whose header cannot be parsed by htslib.
+    The header is repaired in memory and each line is parsed by pysam."""
+    def __init__(self, in_sam):
+        self.handle = open(in_sam, 'r')
+        headerLines = []
+        self.firstLine = self.handle.readline()
+        while self.firstLine.startswith('@'):
+            headerLines.append(self.firstLine)
+            self.firstLine = self.handle.readline()
+        self.header = pysam.AlignmentHeader.from_text(
+            repairHicupHeader(''.join(headerLines)))
+
+    def fetch(self, until_eof=True):
+        line = self.firstLine
+        while line:
+            yield pysam.AlignedSegment.fromstring(line.rstrip('\n'),
+                                                  self.header)
+            line = self.handle.readline()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.handle.close()
+
+
+def openHicupAlignments(in_samOrBam, threads):
+    """Open the sam or bam with pysam.
+    threads are the number of htslib threads used to decompress the bam.
+    If htslib cannot parse the header of a sam (HiCUP v0.6.1)
+    the header is repaired in memory."""
+    try:
+        return pysam.AlignmentFile(in_samOrBam, 'r', threads=threads)
+    except ValueError:
+        with open(in_samOrBam, 'rb') as f:
+            if f.read(1) != b'@':
+                # This is not a sam with a header
+                raise
+        print("The header of the sam could not be parsed."
+              " Trying to repair it.", file=sys.stderr)
+        return SamTextWithRepairedHeader(in_samOrBam)
+
+
+class ReadBatch(object):
+    """Preallocated column buffers for up to size consecutive reads.
+    For each read: name (without /1 or /2), strand (1 for reverse),
+    chromosome id in the header, 0-based start, end (only for reverse reads)
+    and mapq. sameName[i] is True if the read i has the name of the read
+    before it (even if this one was in the previous batch)."""
+    def __init__(self, size):
+        self.size = size
+        self.names = [None] * size
+        self.sameName = np.zeros(size, dtype=bool)
+        self.strands = np.zeros(size, dtype=np.int64)
+        self.chroms = np.zeros(size, dtype=np.int64)
+        self.starts = np.zeros(size, dtype=np.int64)
+        self.ends = np.zeros(size, dtype=np.int64)
+        self.mapqs = np.zeros(size, dtype=np.int64)
+        self.length = 0
+        self.lastName = None
+
+    def fill(self, reads):
+        """Add reads from the iterator reads until the batch is full.
+        Return the number of reads added."""
+        i = self.length
+        if i == self.size:
+            return 0
+        names = self.names
+        sameName = self.sameName
+        strands = self.strands
+        chroms = self.chroms
+        starts = self.starts
+        ends = self.ends
+        mapqs = self.mapqs
+        lastName = self.lastName
+        for read in reads:
+            name = read.query_name.split("/")[0]
+            names[i] = name
+            sameName[i] = name == lastName
+            lastName = name
+            chroms[i] = read.reference_id
+            starts[i] = read.reference_start
+            mapqs[i] = read.mapping_quality
+            if read.is_reverse:
+                strands[i] = 1
+                ends[i] = read.reference_end
+            else:
+                strands[i] = 0
+            i += 1
+            if i == self.size:
+                break
+        added = i - self.length
+        self.length = i
+        self.lastName = lastName
+        return added
+
+    def keepLast(self):
+        'Keep only the last read of the batch, at the first position'
+        last = self.length - 1
+        for column in [self.names, self.sameName, self.strands, self.chroms,
+                       self.starts, self.ends, self.mapqs]:
+            column[0] = column[last]
+        self.length = 1
+
+
+def assignFragments(chroms, positions, references, bigDic):
+    """Find the fragments of all positions with one lookup
+    per chromosome and return the fragment ids, their middles
+    and which positions have a fragment
+    (not before the first fragment of a chromosome of the fragment file)."""
+    frags = np.zeros(len(positions), dtype=np.int64)
+    mids = np.zeros(len(positions), dtype=np.int64)
+    found = np.zeros(len(positions), dtype=bool)
+    order = np.argsort(chroms, kind='stable')
+    bounds = np.flatnonzero(np.diff(chroms[order])) + 1
+    for indices in np.split(order, bounds):
+        if len(indices) == 0:
+            continue
+        refName = references[chroms[indices[0]]]
+        if refName not in bigDic:
+            continue
+        frags[indices], mids[indices], found[indices] = \
+            find_FragAndMid(bigDic[refName], positions[indices])
+    return frags, mids, found
+
+
+class ConversionStats(object):
+    """Counts and cumulative wall time per stage of the conversion.
+    The first maxSingleWarnings single reads are reported on stderr
+    (or only stored if printWarnings is False, in the workers).
+    If progressEvery is not 0, a progress line is printed on stderr
+    every progressEvery reads."""
+    stages = ['read', 'fragment', 'format', 'sort', 'write']
+    countNames = ['reads', 'pairs', 'cisPairs', 'transPairs', 'singleReads',
+                  'readsWithoutFragment', 'pairsWithoutFragment']
+
+    def __init__(self, maxSingleWarnings=10, printWarnings=True,
+                 progressEvery=0):
+        self.maxSingleWarnings = maxSingleWarnings
+        self.printWarnings = printWarnings
+        self.progressEvery = progressEvery
+        self.counts = dict.fromkeys(self.countNames, 0)
+        self.stageTime = dict.fromkeys(self.stages, 0.)
+        self.singleNames = []
+        self.singleWarnings = 0
+        self.startTime = time.time()
+        self.nextProgress = progressEvery
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        'Add the time spent in the with block to stage'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stageTime[stage] += time.time() - start
+
+    def warnSingleRead(self, name):
+        if self.singleWarnings < self.maxSingleWarnings:
+            print(name + (" is a single read or the sam/bam"
+                          " is not sorted by read id."), file=sys.stderr)
+        self.singleWarnings += 1
+
+    def singleRead(self, name):
+        self.counts['singleReads'] += 1
+        if self.printWarnings:
+            self.warnSingleRead(name)
+        elif len(self.singleNames) < self.maxSingleWarnings:
+            self.singleNames.append(name)
+
+    def addReads(self, nReads):
+        self.counts['reads'] += nReads
+        if self.progressEvery > 0 and \
+           self.counts['reads'] >= self.nextProgress:
+            elapsed = time.time() - self.startTime
+            print("%i reads processed in %.1f s (%i reads/s)."
+                  % (self.counts['reads'], elapsed,
+                     self.counts['reads'] / max(elapsed, 1e-9)),
+                  file=sys.stderr)
+            self.nextProgress = (self.counts['reads'] // self.progressEvery
+                                 + 1) * self.progressEvery
+
+    def merge(self, other):
+        'Add the stats of a worker'
+        for name in other.singleNames:
+            self.warnSingleRead(name)
+        for stage in self.stages:
+            self.stageTime[stage] += other.stageTime[stage]
+        reads = other.counts.pop('reads')
+        for name, count in other.counts.items():
+            self.counts[name] += count
+        self.addReads(reads)
+
+    def summary(self):
+        'Print the counts which need attention on stderr'
+        if self.counts['singleReads'] > self.maxSingleWarnings:
+            print("%i single reads in total." % self.counts['singleReads'],
+                  file=sys.stderr)
+        if self.counts['pairsWithoutFragment'] > 0:
+            print("%i pairs were skipped because %i reads have no fragment."
+                  % (self.counts['pairsWithoutFragment'],
+                     self.counts['readsWithoutFragment']), file=sys.stderr)
+
+    def toDict(self):
+        elapsed = time.time() - self.startTime
+        stats = dict(self.counts)
+        stats['wallTime'] = elapsed
+        stats['readsPerSecond'] = self.counts['reads'] / elapsed
+        stats['pairsPerSecond'] = self.counts['pairs'] / elapsed
+        stats['stageTime'] = dict(self.stageTime)
+        return stats
+
+
+def pairFirstReads(sameName, length):
+    """Return the indices of the first read of each pair in the batch.
+    Like reading the reads one by one, a read is paired with the next one
+    if they have the same name, else it is a single read.
+    The batch starts with a read which is not the second read of a pair."""
+    nextIsSame = np.zeros(length, dtype=bool)
+    nextIsSame[:-1] = sameName[1:length]
+    # In a run of reads with the same name, the reads are paired 2 by 2
+    runStarts = np.where(nextIsSame & ~np.concatenate(([False],
+                                                       nextIsSame[:-1])),
+                         np.arange(length), 0)
+    np.maximum.accumulate(runStarts, out=runStarts)
+    return np.flatnonzero(nextIsSame &
+                          ((np.arange(length) - runStarts) % 2 == 0))
+
+
+# Columns of the pairs given to the writers
+# chr are the names of the chromosomes and chrId their index in the header
+PairColumns = collections.namedtuple(
+    'PairColumns', ['readname', 'str1', 'chr1', 'chrId1', 'pos1', 'frag1',
+                    'str2', 'chr2', 'chrId2', 'pos2', 'frag2',
+                    'mapq1', 'mapq2'])
+
+
+def switchMates(pairs, switch):
+    'Switch mate1 and mate2 of the pairs where switch is True'
+    mate1 = ['str1', 'chr1', 'chrId1', 'pos1', 'frag1', 'mapq1']
+    mate2 = ['str2', 'chr2', 'chrId2', 'pos2', 'frag2', 'mapq2']
+    switched = {}
+    for field1, field2 in zip(mate1, mate2):
+        values1 = getattr(pairs, field1)
+        values2 = getattr(pairs, field2)
+        switched[field1] = np.where(switch, values2, values1)
+        switched[field2] = np.where(switch, values1, values2)
+    return pairs._replace(**switched)
+
+
+def formatPairs(lineFormat, *columns):
+    'Format all pairs at once and return the list of lines'
+    columns = [c.tolist() if isinstance(c, np.ndarray) else c
+               for c in columns]
+    return list(map(lineFormat.__mod__, zip(*columns)))
+
+
+def validPairLines(pairs):
+    'Lines of the pairs in the validpair format'
+    return formatPairs(pairFormat, pairs.readname, pairs.str1, pairs.chr1,
+                       pairs.pos1, pairs.frag1, pairs.str2, pairs.chr2,
+                       pairs.pos2, pairs.frag2, pairs.mapq1, pairs.mapq2)
+
+
+def awkCompare(a, b):
+    """Compare 2 fields like awk does:
+    as numbers if both look like numbers else as strings"""
+    if awkNumber.match(a) and awkNumber.match(b):
+        a = float(a)
+        b = float(b)
+    return (a > b) - (a < b)
+
+
+class PairWriter(object):
+    """Write the pairs in the validpair format in fo.
+    In the multi-process mode, each worker has its own writer (with fo=None)
+    whose close() returns the temporary files it wrote in tmpDir.
+    These files are given in order to addParts() of the writer
+    of the main process. finish() is called once all pairs are written."""
+    def __init__(self, fo, tmpDir, stats):
+        self.stats = stats
+        self.chunkFile = None
+        if fo is None:
+            fd, self.chunkFile = tempfile.mkstemp(dir=tmpDir, suffix='.txt')
+            fo = os.fdopen(fd, 'w')
+        self.fo = fo
+
+    def writePairs(self, pairs):
+        with self.stats.timer('format'):
+            lines = ''.join(validPairLines(pairs))
+        with self.stats.timer('write'):
+            self.fo.write(lines)
+
+    def close(self):
+        self.fo.close()
+        return [self.chunkFile]
+
+    def addParts(self, parts):
+        with self.stats.timer('write'):
+            for part in parts:
+                with open(part, 'r') as fi:
+                    shutil.copyfileobj(fi, self.fo)
+                os.remove(part)
+
+    def finish(self):
+        pass
+
+
+class SortedPairWriter(PairWriter):
+    """Switch mate1 and mate2 to have chromosome of mate1<=chromosome of mate2
+    (and position of mate1<=position of mate2 on the same chromosome)
+    and sort the pairs to be compatible with juicebox, like:
+    LC_ALL=C sort -k3,3 -k7,7 -k4,4n -k8,8n
+    The pairs are kept in memory up to maxMemory bytes
+    then sorted and written as a run in tmpDir.
+    The runs are merged with mergeRuns."""
+    def __init__(self, fo, tmpDir, maxMemory, stats):
+        self.stats = stats
+        self.fo = fo
+        self.tmpDir = tmpDir
+        self.maxMemory = maxMemory
+        self.chrOrder = {}
+        self.records = []
+        self.memory = 0
+        self.runs = []
+
+    def writePairs(self, pairs):
+        with self.stats.timer('format'):
+            chrPairs = list(zip(pairs.chr1.tolist(), pairs.chr2.tolist()))
+            for chrPair in set(chrPairs):
+                if chrPair not in self.chrOrder:
+                    self.chrOrder[chrPair] = awkCompare(*chrPair)
+            order = np.array([self.chrOrder[chrPair]
+                              for chrPair in chrPairs], dtype=np.int64)
+            pairs = switchMates(pairs, (order > 0) |
+                                ((order == 0) & (pairs.pos1 > pairs.pos2)))
+            records = list(zip(pairs.chr1.tolist(), pairs.chr2.tolist(),
+                               pairs.pos1.tolist(), pairs.pos2.tolist(),
+                               validPairLines(pairs)))
+        self.addRecords(records)
+
+    def addRecords(self, records):
+        'Store records whose last item is the line to write'
+        self.records += records
+        self.memory += sum(len(record[-1]) for record in records) + \
+            recordOverhead * len(records)
+        if self.memory >= self.maxMemory:
+            self.spill()
+
+    def spill(self):
+        'Write the sorted pairs in memory as a new run'
+        with self.stats.timer('sort'):
+            self.records.sort()
+        with self.stats.timer('write'):
+            self.runs.append(writeRun(self.records, self.tmpDir))
+        self.records = []
+        self.memory = 0
+
+    def close(self):
+        if len(self.records) > 0:
+            self.spill()
+        return self.runs
+
+    def addParts(self, parts):
+        self.runs += parts
+
+    def finish(self):
+        with self.stats.timer('sort'):
+            self.records.sort()
+        with self.stats.timer('write'):
+            mergeRuns(self.runs, self.fo, self.tmpDir, self.records)
+
+
+class TabixPairWriter(SortedPairWriter):
+    """Switch mate1 and mate2 to have the chromosome of mate1 before
+    the chromosome of mate2 in the bam header (or pos1<=pos2 on the same
+    chromosome), i.e. the upper triangle for cooler.
+    Sort the pairs by chr1 pos1 chr2 pos2 like cooler csort -i tabix,
+    compress them with bgzip in outputPath and index it with tabix.
+    If pairsFormat is True the output is a 4DN .pairs file
+    else it is in the juicer medium format."""
+    def __init__(self, outputPath, tmpDir, maxMemory, references, lengths,
+                 headerText, pairsFormat, assembly, stats):
+        SortedPairWriter.__init__(self, None, tmpDir, maxMemory, stats)
+        self.outputPath = outputPath
+        self.references = references
+        self.lengths = lengths
+        self.headerText = headerText
+        self.pairsFormat = pairsFormat
+        self.assembly = assembly
+
+    def writePairs(self, pairs):
+        with self.stats.timer('format'):
+            pairs = switchMates(pairs, (pairs.chrId1 > pairs.chrId2) |
+                                ((pairs.chrId1 == pairs.chrId2) &
+                                 (pairs.pos1 > pairs.pos2)))
+            if self.pairsFormat:
+                strands = np.array(['+', '-'])
+                lines = formatPairs(pairsFormat, pairs.readname, pairs.chr1,
+                                    pairs.pos1, pairs.chr2, pairs.pos2,
+                                    strands[pairs.str1], strands[pairs.str2],
+                                    pairs.frag1, pairs.frag2,
+                                    pairs.mapq1, pairs.mapq2)
+            else:
+                lines = validPairLines(pairs)
+            records = list(zip(pairs.chr1.tolist(), pairs.pos1.tolist(),
+                               pairs.chr2.tolist(), pairs.pos2.tolist(),
+                               lines))
+        self.addRecords(records)
+
+    def pairsHeader(self):
+        'Header of the .pairs file'
+        header = ["## pairs format v1.0",
+                  "#sorted: chr1-pos1-chr2-pos2",
+                  "#shape: upper triangle"]
+        if self.assembly is not None:
+            header.append("#genome_assembly: " + self.assembly)
+        header += ["#chromsize: %s %i" % (chrom, length)
+                   for chrom, length in zip(self.references, self.lengths)]
+        header += ["#samheader: " + line
+                   for line in self.headerText.splitlines()]
+        header.append("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2"
+                      " frag1 frag2 mapq1 mapq2")
+        return "\n".join(header) + "\n"
+
+    def finish(self):
+        with self.stats.timer('sort'):
+            self.records.sort()
+        with self.stats.timer('write'):
+            with io.TextIOWrapper(pysam.BGZFile(self.outputPath,
+                                                'wb')) as fo:
+                if self.pairsFormat:
+                    fo.write(self.pairsHeader())
+                mergeRuns(self.runs, fo, self.tmpDir, self.records)
+            if self.pairsFormat:
+                pysam.tabix_index(self.outputPath, seq_col=1, start_col=2,
+                                  end_col=2, meta_char='#', force=True)
+            else:
+                pysam.tabix_index(self.outputPath, seq_col=2, start_col=3,
+                                  end_col=3, force=True)
+
+
+class CoolPairWriter(PairWriter):
+    """Count the pairs in the bins (a pandas DataFrame with chrom start end)
+    and write them as a cool file in outputPath.
+    The pixels of the pairs are counted by chunks of coolChunkSize pairs.
+    The pixels of each chunk are saved in tmpDir and merged by cooler."""
+    def __init__(self, outputPath, tmpDir, bins, references, assembly,
+                 stats):
+        self.stats = stats
+        self.outputPath = outputPath
+        self.tmpDir = tmpDir
+        self.bins = bins
+        self.assembly = assembly
+        chromIndex = {}
+        self.binOffsets = []
+        self.binStarts = []
+        for chrom, chromBins in bins.groupby('chrom', sort=False):
+            chromIndex[chrom] = len(self.binOffsets)
+            self.binOffsets.append(chromBins.index[0])
+            self.binStarts.append(chromBins['start'].values)
+        # Index in the bins of each chromosome of the header (-1 if absent)
+        self.binChroms = np.array([chromIndex.get(chrom, -1)
+                                   for chrom in references], dtype=np.int64)
+        self.pixels = []
+        self.nPixels = 0
+        self.skippedPairs = 0
+        self.parts = []
+
+    def binIds(self, chromIds, positions):
+        'Bin id of each position (-1 if it is outside of the bins)'
+        binChroms = self.binChroms[chromIds]
+        ids = np.full(len(positions), -1, dtype=np.int64)
+        for i in np.unique(binChroms):
+            if i < 0:
+                continue
+            sel = binChroms == i
+            # Positions are 1-based
+            idx = np.searchsorted(self.binStarts[i], positions[sel] - 1,
+                                  side='right') - 1
+            ids[sel] = np.where(idx < 0, -1, idx + self.binOffsets[i])
+        return ids
+
+    def writePairs(self, pairs):
+        with self.stats.timer('format'):
+            bin1 = self.binIds(pairs.chrId1, pairs.pos1)
+            bin2 = self.binIds(pairs.chrId2, pairs.pos2)
+            valid = (bin1 >= 0) & (bin2 >= 0)
+            self.skippedPairs += int(np.sum(~valid))
+            bin1, bin2 = bin1[valid], bin2[valid]
+            self.pixels.append(np.minimum(bin1, bin2) * len(self.bins) +
+                               np.maximum(bin1, bin2))
+            self.nPixels += len(bin1)
+        if self.nPixels >= coolChunkSize:
+            self.spill()
+
+    def spill(self):
+        'Save the counts of the pixels in memory in a new part'
+        with self.stats.timer('sort'):
+            pixels, counts = np.unique(np.concatenate(self.pixels),
+                                       return_counts=True)
+        with self.stats.timer('write'):
+            fd, part = tempfile.mkstemp(dir=self.tmpDir, suffix='.npz')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, bin1_id=pixels // len(self.bins),
+                         bin2_id=pixels % len(self.bins), count=counts)
+        self.parts.append(part)
+        self.pixels = []
+        self.nPixels = 0
+
+    def close(self):
+        if len(self.pixels) > 0:
+            self.spill()
+        if self.skippedPairs > 0:
+            print("%i pairs are outside of the bins." % self.skippedPairs,
+                  file=sys.stderr)
+        return self.parts
+
+    def addParts(self, parts):
+        self.parts += parts
+
+    def finish(self):
+        # cooler and pandas are only needed for the cool output
+        import cooler
+        import pandas as pd
+        self.close()
+        with self.stats.timer('write'):
+            cooler.create_cooler(self.outputPath, self.bins,
+                                 (pd.DataFrame(dict(np.load(part)))
+                                  for part in self.parts),
+                                 dtypes={'count': np.int64},
+                                 assembly=self.assembly,
+                                 ordered=False, temp_dir=self.tmpDir)
+        for part in self.parts:
+            os.remove(part)
+
+
+def makeBins(bins, references, lengths):
+    """Return the bins as a pandas DataFrame.
+    bins is either the size of the bins or a bed file with the bins."""
+    import cooler
+    import pandas as pd
+    if isinstance(bins, int):
+        return cooler.binnify(pd.Series(lengths, index=references), bins)
+    return pd.read_csv(bins, sep='\t', header=None, usecols=[0, 1, 2],
+                       names=['chrom', 'start', 'end'], comment='#')
+
+
+def makeWriter(outputParams, output, tmpDir, stats):
+    """Return the writer corresponding to outputParams['format'].
+    output is a file object for the juicer format else a path.
+    output is None in the workers of the multi-process mode.
+    The time spent by the writer is added to stats."""
+    outputFormat = outputParams['format']
+    if outputFormat == 'juicer':
+        if outputParams['sortMemory'] is None:
+            return PairWriter(output, tmpDir, stats)
+        return SortedPairWriter(output, tmpDir, outputParams['sortMemory'],
+                                stats)
+    if outputFormat in ['juicer_tabix', 'pairs']:
+        return TabixPairWriter(output, tmpDir, outputParams['sortMemory'],
+                               outputParams['references'],
+                               outputParams['lengths'],
+                               outputParams['headerText'],
+                               outputFormat == 'pairs',
+                               outputParams['assembly'], stats)
+    if outputFormat == 'cool':
+        return CoolPairWriter(output, tmpDir, outputParams['bins'],
+                              outputParams['references'],
+                              outputParams['assembly'], stats)
+    raise ValueError("Unknown output format: " + outputFormat)
+
+
+def writeRun(records, tmpDir):
+    'Write the sorted records by blocks in a new run file of tmpDir'
+    fd, runFile = tempfile.mkstemp(dir=tmpDir, suffix='.run')
+    records = iter(records)
+    with os.fdopen(fd, 'wb') as f:
+        block = list(itertools.islice(records, runBlockSize))
+        while len(block) > 0:
+            pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+            block = list(itertools.islice(records, runBlockSize))
+    return runFile
+
+
+def readRun(runFile):
+    'Yield the records of a run file'
+    with open(runFile, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+
+def mergeRuns(runs, fo, tmpDir, records=()):
+    """Write in fo the lines of the sorted runs (and the sorted records)
+    with a k-way merge. The runs are removed."""
+    # Limit the number of files opened at the same time
+    while len(runs) > maxOpenRuns:
+        mergedRun = writeRun(heapq.merge(*[readRun(r)
+                                           for r in runs[:maxOpenRuns]]),
+                             tmpDir)
+        for r in runs[:maxOpenRuns]:
+            os.remove(r)
+        runs = runs[maxOpenRuns:] + [mergedRun]
+    fo.writelines(record[4]
+                  for record in heapq.merge(records,
+                                            *[readRun(r) for r in runs]))
+    for r in runs:
+        os.remove(r)
+
+
+def writePairs(reads, references, writer, useMid, bigDic, method, stats,
+               firstReadIndex=0):
+    """Write the pairs of consecutive reads with writer (a PairWriter).
+    references are the names of the chromosomes in the header.
+    The reads are processed by batches of batchSize reads.
+    The pairs with a read without fragment are skipped.
+    The counts and the time of each stage are added to stats.
+    firstReadIndex is the index of the first read in the whole file.
+    Return the name of the last read if it was not paired else None."""
+    references = np.array(references, dtype=object)
+    singleReads = 0
+    # Index in the whole file of the first read of the batch
+    batchFirstRead = firstReadIndex
+    batch = ReadBatch(batchSize)
+    reads = iter(reads)
+    while True:
+        with stats.timer('read'):
+            nReads = batch.fill(reads)
+        if nReads == 0:
+            break
+        stats.addReads(nReads)
+        n = batch.length
+        first = pairFirstReads(batch.sameName, n)
+        paired = np.zeros(n, dtype=bool)
+        paired[first] = True
+        paired[first + 1] = True
+        # The last read may be paired with the first read of the next batch
+        singles = np.flatnonzero(~paired[:-1])
+        if len(singles) > 0:
+            # A single read is detected when the next read is read
+            informativeLineNumbers = batchFirstRead + singles + 2
+            tooManySingles = (singleReads + np.arange(1, len(singles) + 1)
+                              > 10) & (informativeLineNumbers < 20)
+            for i, tooMany in zip(singles.tolist(), tooManySingles):
+                stats.singleRead(batch.names[i])
+                if tooMany:
+                    raise Exception(("The sam/bam is probably not sorted"
+                                     " by qname. Job stopped."))
+            singleReads += len(singles)
+        if len(first) > 0:
+            with stats.timer('fragment'):
+                # Mates 1 then mates 2
+                mates = np.concatenate((first, first + 1))
+                strands = batch.strands[mates]
+                chroms = batch.chroms[mates]
+                starts = batch.starts[mates]
+                ends = batch.ends[mates]
+                frags, mids, found = assignFragments(
+                    chroms, lookupPosition(starts, ends, strands, method),
+                    references, bigDic)
+                if useMid:
+                    positions = mids
+                else:
+                    positions = fiveP_oneB_read_start(starts, ends, strands)
+                mapqs = batch.mapqs[mates]
+                m = len(first)
+                withFragments = found[:m] & found[m:]
+                stats.counts['readsWithoutFragment'] += \
+                    int(np.sum(~found))
+                if not np.all(withFragments):
+                    stats.counts['pairsWithoutFragment'] += \
+                        int(np.sum(~withFragments))
+                    first = first[withFragments]
+                    mates = np.concatenate((withFragments, withFragments))
+                    strands = strands[mates]
+                    chroms = chroms[mates]
+                    positions = positions[mates]
+                    frags = frags[mates]
+                    mapqs = mapqs[mates]
+                    m = len(first)
+                cis = int(np.sum(chroms[:m] == chroms[m:]))
+                stats.counts['pairs'] += m
+                stats.counts['cisPairs'] += cis
+                stats.counts['transPairs'] += m - cis
+            writer.writePairs(PairColumns(
+                [batch.names[i] for i in first.tolist()],
+                strands[:m], references[chroms[:m]], chroms[:m],
+                positions[:m], frags[:m],
+                strands[m:], references[chroms[m:]], chroms[m:],
+                positions[m:], frags[m:], mapqs[:m], mapqs[m:]))
+        if paired[-1]:
+            batchFirstRead += n
+            batch.length = 0
+        else:
+            batchFirstRead += n - 1
+            batch.keepLast()
+    if batch.length > 0:
+        return batch.names[0]
+    return None
+
+
+def readBgzfBlock(f, offset):
+    """Return the size and the uncompressed data of the BGZF block at offset
+    of the raw file f (None if there is no valid block)"""
+    f.seek(offset)
+    header = f.read(18)
+    if len(header) < 18 or not header.startswith(bgzfMagic) or \
+       header[10:16] != b'\x06\x00BC\x02\x00':
+        return None
+    blockSize = struct.unpack_from('<H', header, 16)[0] + 1
+    rest = f.read(blockSize - 18)
+    if len(rest) < blockSize - 18:
+        return None
+    try:
+        data = zlib.decompress(rest[:-8], -15)
+    except zlib.error:
+        return None
+    crc, size = struct.unpack_from('<II', rest, len(rest) - 8)
+    if size != len(data) or crc != zlib.crc32(data):
+        return None
+    return blockSize, data
+
+
+def isBamRecord(data, start, nReferences, nextRecords=2):
+    """Whether a bam record seems to begin at start of data
+    (and the nextRecords records after it, until the end of data)"""
+    if start == len(data):
+        return True
+    if start + bamRecordHeader.size > len(data):
+        # We cannot check more
+        return nextRecords < 2
+    (blockSize, refID, pos, nameLength, _, _, nCigar, _, seqLength,
+     mateRefID, matePos, _) = bamRecordHeader.unpack_from(data, start)
+    if not (-1 <= refID < nReferences and -1 <= mateRefID < nReferences and
+            pos >= -1 and matePos >= -1 and nameLength > 1 and
+            blockSize >= 32 + nameLength + 4 * nCigar +
+            (seqLength + 1) // 2 + seqLength):
+        return False
+    nameStart = start + bamRecordHeader.size
+    name = data[nameStart:nameStart + nameLength]
+    if len(name) == nameLength and \
+       (name[-1] != 0 or any(c < 33 or c > 126 for c in name[:-1])):
+        return False
+    if nextRecords == 0:
+        return True
+    return isBamRecord(data, start + 4 + blockSize, nReferences,
+                       nextRecords - 1)
+
+
+def findBamRecord(raw, offset, nReferences):
+    """Return the virtual offset of the first bam record which begins
+    in the first BGZF block at or after the offset of the raw bam
+    (None if there is none)"""
+    while True:
+        raw.seek(offset)
+        window = raw.read(1 << 16)
+        if len(window) == 0:
+            return None
+        i = window.find(bgzfMagic)
+        if i < 0:
+            offset += len(window) - len(bgzfMagic) + 1
+            continue
+        blockStart = offset + i
+        block = readBgzfBlock(raw, blockStart)
+        if block is None:
+            # The magic is in compressed data
+            offset = blockStart + 1
+            continue
+        blockSize, data = block
+        # The next block to check the records which go over this one
+        nextBlock = readBgzfBlock(raw, blockStart + blockSize)
+        if nextBlock is not None:
+            data += nextBlock[1]
+        for start in range(len(block[1])):
+            if isBamRecord(data, start, nReferences):
+                return (blockStart << 16) | start
+        # No record begins in this block
+        offset = blockStart + blockSize
+
+
+def pairChunks(in_bam, readsPerChunk, threads):
+    """Yield (first read, name of the first read, end, name of the read at
+    the end, estimated index of the first read) for successive chunks of
+    about readsPerChunk reads of the bam.
+    The reads are not read: the split points are records found in the BGZF
+    blocks at regular compressed offsets, the number of compressed bytes
+    by read being estimated on the first reads.
+    A chunk begins after the reads with the name of its first read
+    and ends after the reads with the name of the read at its end, so
+    a chunk never ends between 2 reads with the same name (see
+    chunkReads)."""
+    with pysam.AlignmentFile(in_bam, 'rb', threads=threads) as f:
+        nReferences = f.nreferences
+        firstOffset = f.tell()
+        nSampled = 0
+        for _ in itertools.islice(f.fetch(until_eof=True), chunkSampleReads):
+            nSampled += 1
+        sampledBytes = (f.tell() >> 16) - (firstOffset >> 16)
+    if nSampled < chunkSampleReads:
+        # All the reads were read
+        sampledBytes = os.path.getsize(in_bam) - (firstOffset >> 16)
+    chunkBytes = max(1, int(sampledBytes / max(1, nSampled) * readsPerChunk))
+    splits = [(firstOffset, None)]
+    with open(in_bam, 'rb') as raw, pysam.AlignmentFile(in_bam, 'rb') as f:
+        for offset in range((firstOffset >> 16) + chunkBytes,
+                            os.path.getsize(in_bam), chunkBytes):
+            recordOffset = findBamRecord(raw, offset, nReferences)
+            if recordOffset is None:
+                break
+            if recordOffset <= splits[-1][0]:
+                continue
+            f.seek(recordOffset)
+            read = next(f.fetch(until_eof=True), None)
+            if read is None:
+                break
+            splits.append((recordOffset, read.qname.split("/")[0]))
+    splits.append((None, None))
+    for k in range(len(splits) - 1):
+        yield splits[k] + splits[k + 1] + (k * readsPerChunk,)
+
+
+def chunkReads(f, startName, end, endName):
+    """Yield the reads of the bam f from its current position
+    after the reads named startName until the first read after the
+    virtual offset end (and the reads named endName)"""
+    offset = f.tell()
+    for read in f.fetch(until_eof=True):
+        name = read.qname.split("/")[0]
+        if startName is not None:
+            if name == startName:
+                offset = f.tell()
+                continue
+            startName = None
+        if end is not None and offset >= end and name != endName:
+            return
+        yield read
+        offset = f.tell()
+
+
+def initWorker(bigDic):
+    'Store the fragments in the worker (shared with the parent by fork)'
+    global workerFragments
+    workerFragments = bigDic
+
+
+def convertChunk(params):
+    """Worker of the multi-process mode:
+    write the pairs of a chunk of the bam with a writer of outputParams.
+    Return the temporary files of the writer,
+    the name of the last read if it was not paired
+    and the stats of the chunk"""
+    (in_bam, useMid, method, tmpDir, outputParams, singleReadWarnings,
+     (start, startName, end, endName, firstRead)) = params
+    stats = ConversionStats(singleReadWarnings, printWarnings=False)
+    with pysam.AlignmentFile(in_bam, 'rb') as f:
+        f.seek(start)
+        reads = chunkReads(f, startName, end, endName)
+        writer = makeWriter(outputParams, None, tmpDir, stats)
+        lastUnpaired = writePairs(reads, outputParams['references'],
+                                  writer, useMid, workerFragments,
+                                  method, stats, firstRead)
+        parts = writer.close()
+    return parts, lastUnpaired, stats
 
 
 def readSamFromHicupAndWriteOutputForJuicebox(in_samOrBam,
-                                              fo, useMid, bigDic, method):
+                                              output, useMid, bigDic, method,
+                                              threads=1, processes=1,
+                                              readsPerChunk=2000000,
+                                              sortMemory=None, tmpDir=None,
+                                              outputFormat='juicer',
+                                              bins=None, assembly=None,
+                                              singleReadWarnings=10,
+                                              progressEvery=0):
     """"return the validpair file
     <readname> <str1> <chr1> <pos1> <frag1> <str2>
     <chr2> <pos2> <frag2> <mapq1> <mapq2>
@@ -91,73 +1129,75 @@ def readSamFromHicupAndWriteOutputForJuicebox(in_samOrBam,
     where the position used to find the fragment is 10 bp downstream
     the most upstream coordinate of the mapped positions
     (the one given by bowtie)).
-    or the middle of the fragment."""
-    singleReads = 0
-    informativeLineNumber = 0
-    pairOnGoing = False
-    tmpDir = tempfile.mkdtemp()
-    os.mkfifo(tmpDir+'bampipe')
-    # With HiCUP v0.6.1
-    # The header is malformated:
-    # @PG     ID:HiCUP Filter VN:0.6.1        DS:"Max insert 0 Min insert 0 Digest file digester_file.txt"
-    # @PG     HiCUP Deduplicator      VN:0.6.1
-    # So we skip this line
-    command = 'samtools view -h '+in_samOrBam+' | grep -v "HiCUP Deduplicator" > '+tmpDir+'bampipe'
-    subprocess.Popen(command, shell=True)
-    with pysam.Samfile(tmpDir+'bampipe', 'r') as f:
-        for read in f.fetch():
-            informativeLineNumber += 1
-            bowtieReadPos = read.reference_start+1
-            refName = read.reference_name
-            if method == 'hicup':
-                fragInfo = find_FragAndMid(bigDic[refName],
-                                           bowtieReadPos+10)
-                # this bowtie+10 is to follow hicup_filter <= 6.1.0
-            elif method == 'hiclib':
-                if read.is_reverse:
-                    fragInfo = find_FragAndMid(bigDic[refName],
-                                               read.reference_end-4)
-                else:
-                    fragInfo = find_FragAndMid(bigDic[refName],
-                                               bowtieReadPos+4)
-            if useMid:
-                currentPos = fragInfo[1]
-            else:
-                currentPos = fiveP_oneB_read_start(read)
-            if not pairOnGoing:
-                readname = read.qname.split("/")[0]
-                str1 = int(read.is_reverse)
-                chr1 = refName
-                pos1 = currentPos
-                frag1 = fragInfo[0]
-                mapq1 = read.mapping_quality
-                pairOnGoing = True
-            else:
-                # This should be the same id
-                if readname != read.qname.split("/")[0]:
-                    singleReads += 1
-                    print(readname +
-                          (" is a single read or the sam/bam"
-                           " is not sorted by read id."))
-                    readname = read.qname.split("/")[0]
-                    str1 = int(read.is_reverse)
-                    chr1 = refName
-                    pos1 = currentPos
-                    frag1 = fragInfo[0]
-                    mapq1 = read.mapping_quality
-                    if(singleReads > 10 and informativeLineNumber < 20):
-                        raise Exception(("The sam/bam is probably not sorted"
-                                         " by qname. Job stopped."))
-                else:
-                    str2 = int(read.is_reverse)
-                    chr2 = refName
-                    pos2 = currentPos
-                    frag2 = fragInfo[0]
-                    mapq2 = read.mapping_quality
-                    pairOnGoing = False
-                    fo.write("%s\t%i\t%s\t%i\t%i\t%i\t%s\t%i\t%i\t%i\t%i\n"
-                             % (readname, str1, chr1, pos1, frag1, str2, chr2,
-                                pos2, frag2, mapq1, mapq2))
+    or the middle of the fragment.
+    With processes > 1, the bam is split in chunks of about readsPerChunk
+    reads which are processed in parallel and concatenated in order.
+    If sortMemory is not None, R1 and R2 are switched if chr2<chr1 and the
+    pairs are sorted by chr1 chr2 pos1 pos2 using sortMemory bytes
+    and temporary files in tmpDir.
+    output is a file object for the 'juicer' outputFormat.
+    Other outputFormat write in the path output:
+    'juicer_tabix' and 'pairs' are sorted by chr1 pos1 chr2 pos2,
+    compressed with bgzip and indexed with tabix,
+    'cool' counts the pairs in the bins (bin size or bed file).
+    Only the first singleReadWarnings single reads are reported.
+    If progressEvery is not 0, the progress is reported every progressEvery
+    reads.
+    Return the ConversionStats of the conversion."""
+    stats = ConversionStats(singleReadWarnings, True, progressEvery)
+    tmpDir = tempfile.mkdtemp(dir=tmpDir)
+    try:
+        with openHicupAlignments(in_samOrBam, threads) as f:
+            references = list(f.header.references)
+            lengths = list(f.header.lengths)
+            outputParams = {
+                'format': outputFormat,
+                'sortMemory': sortMemory,
+                'references': references,
+                'lengths': lengths,
+                'headerText': repairHicupHeader(str(f.header)),
+                'bins': (makeBins(bins, references, lengths)
+                         if outputFormat == 'cool' else None),
+                'assembly': assembly
+            }
+            writer = makeWriter(outputParams, output, tmpDir, stats)
+            if processes <= 1 or not getattr(f, 'is_bam', False):
+                if processes > 1:
+                    print("Only bam can be processed with multiple"
+                          " processes.", file=sys.stderr)
+                lastUnpaired = writePairs(f.fetch(until_eof=True),
+                                          references, writer, useMid,
+                                          bigDic, method, stats)
+                writer.finish()
+                if lastUnpaired is not None:
+                    stats.counts['singleReads'] += 1
+                stats.summary()
+                return stats
+        if sortMemory is not None:
+            outputParams['sortMemory'] = sortMemory // processes
+        chunks = ((in_samOrBam, useMid, method, tmpDir, outputParams,
+                   singleReadWarnings, chunk)
+                  for chunk in pairChunks(in_samOrBam, readsPerChunk,
+                                          threads))
+        with multiprocessing.get_context('fork').Pool(
+                processes, initializer=initWorker,
+                initargs=(bigDic,)) as pool:
+            lastUnpaired = None
+            for parts, chunkLastUnpaired, chunkStats in \
+                    pool.imap(convertChunk, chunks):
+                if lastUnpaired is not None:
+                    # The next chunk starts with another read name
+                    stats.singleRead(lastUnpaired)
+                lastUnpaired = chunkLastUnpaired
+                stats.merge(chunkStats)
+                writer.addParts(parts)
+        writer.finish()
+        if lastUnpaired is not None:
+            stats.counts['singleReads'] += 1
+        stats.summary()
+        return stats
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
 
 
 argp = argparse.ArgumentParser(
@@ -169,9 +1209,9 @@ argp = argparse.ArgumentParser(
                " pos = 5'of the read unless --useMid is used.)"))
 argp.add_argument('sam', default=None,
                   help="Input sam or bam with pairs like hicup output.")
-argp.add_argument('--output', default=sys.stdout,
-                  type=argparse.FileType('w'),
-                  help="Output valid pair file.")
+argp.add_argument('--output', default=None,
+                  help=("Output valid pair file (default is stdout,"
+                        " mandatory if --outputFormat is not juicer)."))
 argp.add_argument('--fragmentFile', default=None,
                   help=("A file containing the coordinates"
                         " of each fragment id."))
@@ -199,11 +1239,99 @@ argp.add_argument('--methodForFrag',
                         " upstream coordinate. hiclib is 4 bases after the 5'"
                         " if strand is + and 4 bases before if strand is -."),
                   choices=['hicup', 'hiclib'], default='hicup')
+argp.add_argument('--fragmentCache', default=None,
+                  help=("Directory where the processed fragment files are"
+                        " stored to be reused by the next runs"
+                        " with the same fragment file and columns."))
+argp.add_argument('--fragmentCacheSize', default=10000, type=int,
+                  help=("Maximum size in MB of the directory given in"
+                        " --fragmentCache. The least recently used"
+                        " fragment files are removed above this size."))
+argp.add_argument('--decompressionThreads', default=1, type=int,
+                  help="Number of threads used to decompress the bam.")
+argp.add_argument('--threads', default=1, type=int,
+                  help=("Number of processes used to convert the bam."
+                        " The bam is split in chunks of about"
+                        " --readsPerChunk reads which never split a pair."))
+argp.add_argument('--readsPerChunk', default=2000000, type=int,
+                  help=("Approximate number of reads per chunk with"
+                        " --threads (estimated from the compressed size of"
+                        " the first reads)."))
+argp.add_argument('--sortOutput', action="store_true",
+                  help=("Switch R1 and R2 if chr2<chr1 (or pos2<pos1)"
+                        " and sort the output by chr1 chr2 pos1 pos2"
+                        " to be compatible with juicebox."))
+argp.add_argument('--sortMemory', default=1024, type=int,
+                  help=("Memory in MB used to sort the pairs with"
+                        " --sortOutput before writing temporary files."))
+argp.add_argument('--outputFormat', default='juicer',
+                  choices=['juicer', 'juicer_tabix', 'pairs', 'cool'],
+                  help=("juicer is the validpair text file."
+                        " juicer_tabix is the validpair file sorted by"
+                        " chr1 pos1 chr2 pos2 (upper triangle in the order of"
+                        " the bam header), compressed with bgzip and indexed"
+                        " with tabix for cooler cload tabix."
+                        " pairs is the same in the 4DN .pairs format."
+                        " cool is a cool file with the counts of pairs"
+                        " in --binSize or --bins."))
+argp.add_argument('--binSize', default=None, type=int,
+                  help="Size of the bins for --outputFormat cool.")
+argp.add_argument('--bins', default=None,
+                  help=("Bed file with the bins for --outputFormat cool"
+                        " (for example the output of cooler makebins)."))
+argp.add_argument('--assembly', default=None,
+                  help="Name of the genome assembly for pairs and cool.")
+argp.add_argument('--stats', default=None,
+                  help=("Write the statistics of the conversion in this file"
+                        " (json with the number of reads, pairs, cis and"
+                        " trans pairs, single reads, reads without fragment,"
+                        " throughput and time spent in each stage)."))
+argp.add_argument('--singleReadWarnings', default=10, type=int,
+                  help=("Number of single reads which are reported"
+                        " individually (default is 10)."))
+argp.add_argument('--progress', default=0, type=int,
+                  help=("Report the progress every PROGRESS reads"
+                        " (default is 0, no report)."))
+argp.add_argument('--tmpDir', default=None,
+                  help=("Directory for the temporary files"
+                        " (default is the system temporary directory)."))
 args = argp.parse_args()
+if args.outputFormat == 'juicer':
+    if args.output is None:
+        output = sys.stdout
+    else:
+        output = open(args.output, 'w')
+else:
+    if args.output is None:
+        argp.error("--output is mandatory with --outputFormat "
+                   + args.outputFormat)
+    output = args.output
+if args.outputFormat == 'cool' and (args.binSize is None) == \
+   (args.bins is None):
+    argp.error("--outputFormat cool needs --binSize or --bins.")
 print("Processing fragment file...", file=sys.stderr)
-bigDic = loadFragFile(args.fragmentFile, args.colForChr-1, args.colForStart-1,
-                      args.colForEnd-1, args.colForID-1,
-                      args.lineToSkipInFragmentFile)
+if args.fragmentCache is None:
+    bigDic = loadFragFile(args.fragmentFile, args.colForChr-1,
+                          args.colForStart-1, args.colForEnd-1,
+                          args.colForID-1, args.lineToSkipInFragmentFile)
+else:
+    bigDic = loadFragFileWithCache(args.fragmentFile, args.colForChr-1,
+                                   args.colForStart-1, args.colForEnd-1,
+                                   args.colForID-1,
+                                   args.lineToSkipInFragmentFile,
+                                   args.fragmentCache,
+                                   args.fragmentCacheSize * 1024 * 1024)
 print("Fragment file processed.", file=sys.stderr)
-readSamFromHicupAndWriteOutputForJuicebox(args.sam, args.output, args.useMid,
-                                          bigDic, args.methodForFrag)
+stats = readSamFromHicupAndWriteOutputForJuicebox(
+    args.sam, output, args.useMid, bigDic, args.methodForFrag,
+    args.decompressionThreads, args.threads, args.readsPerChunk,
+    args.sortMemory * 1024 * 1024
+    if args.sortOutput or args.outputFormat != 'juicer' else None,
+    args.tmpDir, args.outputFormat,
+    args.binSize if args.bins is None else args.bins, args.assembly,
+    args.singleReadWarnings, args.progress)
+if args.outputFormat == 'juicer':
+    output.close()
+if args.stats is not None:
+    with open(args.stats, 'w') as fo:
+        json.dump(stats.toDict(), fo, indent=2)
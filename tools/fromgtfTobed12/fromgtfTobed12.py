@@ -1,125 +1,658 @@
 import argparse
+import gzip
+import hashlib
+import heapq
+import multiprocessing
+import os
+import pickle
+import shutil
 import sys
-import warnings
-
-import gffutils
-
-warnings.filterwarnings("ignore", message="It appears you have a gene feature"
-                        " in your GTF file. You may want to use the "
-                        "`disable_infer_genes` option to speed up database "
-                        "creation")
-warnings.filterwarnings("ignore", message="It appears you have a transcript "
-                        "feature in your GTF file. You may want to use the "
-                        "`disable_infer_transcripts` option to speed up "
-                        "database creation")
-# In gffutils v0.10 they changed the error message:
-warnings.filterwarnings("ignore", message="It appears you have a gene feature"
-                        " in your GTF file. You may want to use the "
-                        "`disable_infer_genes=True` option to speed up "
-                        "database creation")
-warnings.filterwarnings("ignore", message="It appears you have a transcript "
-                        "feature in your GTF file. You may want to use the "
-                        "`disable_infer_transcripts=True` option to speed up "
-                        "database creation")
+import tempfile
+from array import array
 
+import numpy as np
 
-def convert_gtf_to_bed(fn, fo, preferedName, mergeTranscripts,
-                       mergeTranscriptsAndOverlappingExons, ucsc):
-    db = gffutils.create_db(fn, ':memory:')
-    # For each transcript:
-    if preferedName is not None:
-        prefered_name = preferedName
-    elif mergeTranscripts or mergeTranscriptsAndOverlappingExons:
-        prefered_name = "gene_name"
-    else:
-        prefered_name = "transcript_name"
-    if mergeTranscripts or mergeTranscriptsAndOverlappingExons:
-        all_items = db.features_of_type("gene", order_by='start')
-    else:
-        all_items = db.features_of_type("transcript", order_by='start')
-    for tr in all_items:
+BED12_MODES = ['transcripts', 'mergeTranscripts',
+               'mergeTranscriptsAndOverlappingExons']
+# Attributes always stored in the annotation cache
+DEFAULT_NAME_KEYS = ['transcript_name', 'gene_name', 'transcript_id',
+                     'gene_id']
+# To change when GtfAnnotation changes
+CACHE_VERSION = 'GtfAnnotation 1'
+
+
+def open_gtf(fn):
+    """ Open the gtf (can be gzip) as text"""
+    with open(fn, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(fn, 'rt')
+    return open(fn, 'r')
+
+
+def get_attribute(attributes, key):
+    """ Return the first value of the attribute key in the attributes
+    of a gtf line or None if there is none.
+    Like gffutils, the quotes are removed and the value is split on ','
+    (unless it contains ', ')."""
+    start = 0
+    while True:
+        start = attributes.find(key + ' ', start)
+        if start == -1:
+            return None
+        if start == 0 or attributes[start - 1] in '; \t':
+            break
+        start += len(key)
+    start += len(key) + 1
+    end = attributes.find(';', start)
+    if end == -1:
+        end = len(attributes)
+    value = attributes[start:end].strip().strip('"')
+    if value == '':
+        return None
+    if ', ' not in value:
+        value = value.split(',')[0]
+    return value
+
+
+def gffutils_id_before(number, other):
+    """ Return if the gffutils id of the number-th exon (or CDS) is before
+    the one of the other-th one (gffutils ids are exon_1, exon_2...
+    which are ordered as text)"""
+    return str(number) < str(other)
+
+
+class FeatureTable(object):
+    """ The transcripts or the genes of a gtf.
+    Each feature has an index. Its line in the gtf (None if there is none),
+    its attributes of the name_keys and the CDS are stored by index."""
+    def __init__(self, featuretype, name_keys):
+        self.featuretype = featuretype
+        self.name_keys = name_keys
+        self.index = {}
+        self.ids = []
+        # (order, chrom, start, end, strand) where order is
+        # (0, line number) or (1, ...) for inferred features
+        self.lines = []
+        self.names = {key: [] for key in name_keys}
+        # Other features related (genes of the transcripts)
+        self.related = []
+        # First start and (start, gffutils number, end) of the CDS
+        # with the largest start
+        self.cds_first = []
+        self.cds_last = []
+        self.autoincrement = 0
+
+    def get(self, feature_id):
+        """ Return the index of feature_id (added if it is new)"""
+        i = self.index.get(feature_id)
+        if i is None:
+            i = len(self.ids)
+            self.index[feature_id] = i
+            self.ids.append(feature_id)
+            self.lines.append(None)
+            for key in self.name_keys:
+                self.names[key].append(None)
+            self.related.append(None)
+            self.cds_first.append(None)
+            self.cds_last.append(None)
+        return i
+
+    def add_line(self, feature_id, line, attributes):
+        """ Add the line (line number, chrom, start, end, strand)
+        of the feature (its id is None if it has no transcript_id/gene_id)"""
+        if feature_id is None:
+            # Like gffutils
+            self.autoincrement += 1
+            feature_id = '%s_%i' % (self.featuretype, self.autoincrement)
+        i = self.get(feature_id)
+        if self.lines[i] is not None:
+            raise ValueError("Duplicate ID " + feature_id)
+        self.lines[i] = line
+        for key in self.name_keys:
+            self.names[key][i] = get_attribute(attributes, key)
+
+    def add_related(self, i, other_id):
+        if self.related[i] is None:
+            self.related[i] = [other_id]
+        elif other_id not in self.related[i]:
+            self.related[i].append(other_id)
+
+    def add_cds(self, i, number, start, end):
+        """ Add the number-th CDS of the gtf to the feature i"""
+        if self.cds_first[i] is None or start < self.cds_first[i]:
+            self.cds_first[i] = start
+        last = self.cds_last[i]
+        if last is None or start > last[0] or \
+           (start == last[0] and gffutils_id_before(number, last[1])):
+            self.cds_last[i] = (start, number, end)
+
+
+class GtfAnnotation(object):
+    """ The transcripts and the genes of a gtf with their exons and CDS
+    read in a single pass. It gives the same features as a gffutils
+    database (gffutils.create_db):
+    - exons and CDS are children of the transcript of their transcript_id
+    and of the gene of their gene_id,
+    - transcripts and genes which have exons but no line in the gtf are
+    inferred from the extent of their exons and only have
+    the transcript_id and gene_id attributes,
+    - features are ordered by start then by their line in the gtf (the
+    inferred features are after, ordered by gene_id then transcript_id),
+    - exons are ordered by start then by their gffutils id (exon_1,
+    exon_2... as text).
+    Only the attributes of name_keys are kept."""
+    def __init__(self, name_keys):
+        self.name_keys = list(name_keys)
+        self.transcripts = FeatureTable('transcript', self.name_keys)
+        self.genes = FeatureTable('gene', self.name_keys)
+        # Exons as arrays with the index of their transcript and gene
+        # (-1 if none) and a code for the value of each name key
+        # (-1 if none, see values)
+        self.exon_starts = array('q')
+        self.exon_ends = array('q')
+        self.exon_chroms = []
+        self.exon_strands = []
+        self.exon_transcripts = array('q')
+        self.exon_genes = array('q')
+        self.exon_names = {key: array('q') for key in self.name_keys}
+        self.values = []
+        self.value_codes = {}
+        self.exon_orders = {}
+
+    def value_code(self, value):
+        if value is None:
+            return -1
+        code = self.value_codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.value_codes[value] = code
+            self.values.append(value)
+        return code
+
+    def read(self, fn):
+        n_cds = 0
+        chrom_codes = {}
+        with open_gtf(fn) as f:
+            for line_number, line in enumerate(f):
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) < 9:
+                    continue
+                featuretype = fields[2]
+                attributes = fields[8]
+                transcript_id = get_attribute(attributes, 'transcript_id')
+                gene_id = get_attribute(attributes, 'gene_id')
+                t = -1
+                g = -1
+                if transcript_id is not None:
+                    t = self.transcripts.get(transcript_id)
+                if gene_id is not None:
+                    g = self.genes.get(gene_id)
+                    if transcript_id is not None:
+                        self.transcripts.add_related(t, gene_id)
+                if featuretype == 'exon':
+                    self.exon_starts.append(int(fields[3]))
+                    self.exon_ends.append(int(fields[4]))
+                    # Keep only one string per chromosome
+                    chrom = chrom_codes.setdefault(fields[0], fields[0])
+                    self.exon_chroms.append(chrom)
+                    self.exon_strands.append(fields[6])
+                    self.exon_transcripts.append(t)
+                    self.exon_genes.append(g)
+                    for key in self.name_keys:
+                        self.exon_names[key].append(
+                            self.value_code(get_attribute(attributes, key)))
+                elif featuretype == 'CDS':
+                    n_cds += 1
+                    start = int(fields[3])
+                    end = int(fields[4])
+                    if t != -1:
+                        self.transcripts.add_cds(t, n_cds, start, end)
+                    if g != -1:
+                        self.genes.add_cds(g, n_cds, start, end)
+                elif featuretype in ['transcript', 'gene']:
+                    line = ((0, line_number), fields[0], int(fields[3]),
+                            int(fields[4]), fields[6])
+                    if featuretype == 'transcript':
+                        self.transcripts.add_line(transcript_id, line,
+                                                  attributes)
+                    else:
+                        self.genes.add_line(gene_id, line, attributes)
+        self.exon_starts = np.frombuffer(self.exon_starts, dtype=np.int64)
+        self.exon_ends = np.frombuffer(self.exon_ends, dtype=np.int64)
+        self.exon_transcripts = np.frombuffer(self.exon_transcripts,
+                                              dtype=np.int64)
+        self.exon_genes = np.frombuffer(self.exon_genes, dtype=np.int64)
+        for key in self.name_keys:
+            self.exon_names[key] = np.frombuffer(self.exon_names[key],
+                                                 dtype=np.int64)
+        self.transcripts_with_exons = np.zeros(len(self.transcripts.ids),
+                                               dtype=bool)
+        self.transcripts_with_exons[self.exon_transcripts[
+            self.exon_transcripts >= 0]] = True
+        self.infer_transcripts()
+        self.infer_genes()
+
+    def exon_groups(self, table):
+        if table is self.transcripts:
+            return self.exon_transcripts
+        return self.exon_genes
+
+    def infer(self, table, to_infer, values):
+        """ Infer the features to_infer of the table from their exons:
+        values gives the name of each name key and the order"""
+        groups = self.exon_groups(table)
+        has_exon = groups >= 0
+        groups = groups[has_exon]
+        n = len(table.ids)
+        starts = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(starts, groups, self.exon_starts[has_exon])
+        ends = np.full(n, -1, dtype=np.int64)
+        np.maximum.at(ends, groups, self.exon_ends[has_exon])
+        # The location of the first exon
+        first_exons = np.full(n, -1, dtype=np.int64)
+        exons = np.flatnonzero(has_exon)
+        first_exons[groups[::-1]] = exons[::-1]
+        for i in to_infer:
+            if first_exons[i] == -1:
+                continue
+            names, order = values(i)
+            exon = first_exons[i]
+            table.lines[i] = (order, self.exon_chroms[exon],
+                              int(starts[i]), int(ends[i]),
+                              self.exon_strands[exon])
+            for key in self.name_keys:
+                table.names[key][i] = names.get(key)
+
+    def infer_transcripts(self):
+        transcripts = self.transcripts
+
+        def values(i):
+            transcript_id = transcripts.ids[i]
+            gene_id = min(transcripts.related[i])
+            return ({'transcript_id': transcript_id, 'gene_id': gene_id},
+                    (1, gene_id, transcript_id))
+        self.infer(transcripts,
+                   [i for i in range(len(transcripts.ids))
+                    if transcripts.lines[i] is None and
+                    self.transcripts_with_exons[i] and
+                    transcripts.related[i] is not None],
+                   values)
+
+    def infer_genes(self):
+        genes = self.genes
+        # Genes of the transcripts with exons
+        gene_ids = set()
+        for i, gene_ids_of_transcript in enumerate(self.transcripts.related):
+            if gene_ids_of_transcript is not None and \
+               self.transcripts_with_exons[i]:
+                gene_ids.update(gene_ids_of_transcript)
+
+        def values(i):
+            gene_id = genes.ids[i]
+            return {'gene_id': gene_id}, (1, gene_id)
+        self.infer(genes,
+                   [genes.index[gene_id] for gene_id in gene_ids
+                    if genes.lines[genes.index[gene_id]] is None],
+                   values)
+
+    def ordered_features(self, table):
+        """ Return the index of the features of the table ordered by start"""
+        features = [i for i, line in enumerate(table.lines)
+                    if line is not None]
+        features.sort(key=lambda i: (table.lines[i][2], table.lines[i][0]))
+        return features
+
+    def exon_order(self, table):
+        """ Return the exons ordered by feature of the table and by start
+        and the offsets of the exons of each feature in this order"""
+        if table.featuretype in self.exon_orders:
+            return self.exon_orders[table.featuretype]
+        groups = self.exon_groups(table)
+        # lexsort is stable so exons with the same start are in the gtf order
+        order = np.lexsort((self.exon_starts, groups))
+        order = order[groups[order] >= 0]
+        sorted_groups = groups[order]
+        sorted_starts = self.exon_starts[order]
+        same_start = np.flatnonzero(
+            (sorted_groups[1:] == sorted_groups[:-1]) &
+            (sorted_starts[1:] == sorted_starts[:-1]))
+        if len(same_start) > 0:
+            # Exons with the same start are ordered by gffutils id
+            is_run_start = np.ones(len(same_start), dtype=bool)
+            is_run_start[1:] = same_start[1:] != same_start[:-1] + 1
+            run_starts = same_start[is_run_start]
+            run_ends = np.append(same_start[:-1][is_run_start[1:]],
+                                 same_start[-1]) + 2
+            for run_start, run_end in zip(run_starts.tolist(),
+                                          run_ends.tolist()):
+                order[run_start:run_end] = sorted(
+                    order[run_start:run_end].tolist(),
+                    key=lambda exon: str(exon + 1))
+        offsets = np.searchsorted(sorted_groups,
+                                  np.arange(len(table.ids) + 1))
+        self.exon_orders[table.featuretype] = (order, offsets)
+        return order, offsets
+
+
+def get_bed12_features(annotation, table, prefered_name, features):
+    """ Return the bed12 fields of the features (indices in the table)
+    as a dictionary. The exons of the features are concatenated in
+    exon_starts (0-based) and exon_ends, exon_offsets gives the exons
+    of each feature."""
+    exon_order, exon_offsets = annotation.exon_order(table)
+    exon_names = annotation.exon_names[prefered_name]
+    bed_features = {'chroms': [], 'starts': [], 'ends': [], 'names': [],
+                    'strands': [], 'cds_starts': [], 'cds_ends': []}
+    exons = []
+    for i in features:
+        _, chrom, tr_start, tr_end, strand = table.lines[i]
+        feature_exons = exon_order[exon_offsets[i]:exon_offsets[i + 1]]
+        exons.append(feature_exons)
         # The name would be the name of the transcript/gene if exists
-        try:
-            # First try to have it directly on the feature
-            trName = tr.attributes[prefered_name][0]
-        except KeyError:
-            # Else try to guess the name of the transcript/gene from exons:
-            try:
-                trName = set([e.attributes[prefered_name][0]
-                              for e in
-                              db.children(tr,
-                                          featuretype='exon',
-                                          order_by='start')]).pop()
-            except KeyError:
+        trName = table.names[prefered_name][i]
+        if trName is None:
+            # Else try to guess the name of the transcript/gene from exons
+            # (if all exons have a name)
+            names = exon_names[feature_exons]
+            if len(names) > 0 and names.min() >= 0:
+                trName = annotation.values[names[0]]
+            else:
                 # Else take the transcript id
-                trName = tr.id
+                trName = table.ids[i]
         # If the cds is defined in the gtf,
         # use it to define the thick start and end
         # The gtf is 1-based closed intervalls and
         # bed are 0-based half-open so:
         # I need to remove one from each start
-        try:
+        if table.cds_first[i] is not None:
             # In case of multiple CDS (when there is one entry per gene)
             # I use the first one to get the start
-            # and the last one to get the end (order_by=-start)
-            cds_start = next(db.children(tr,
-                                         featuretype='CDS',
-                                         order_by='start')).start - 1
-            cds_end = next(db.children(tr,
-                                       featuretype='CDS',
-                                       order_by='-start')).end
-        except StopIteration:
+            # and the last one to get the end
+            cds_start = table.cds_first[i] - 1
+            cds_end = table.cds_last[i][2]
+        else:
             # If the CDS is not defined, then it is set to the start
             # as proposed here:
             # https://genome.ucsc.edu/FAQ/FAQformat.html#format1
-            cds_start = tr.start - 1
-            cds_end = tr.start - 1
+            cds_start = tr_start - 1
+            cds_end = tr_start - 1
+        bed_features['chroms'].append(chrom)
+        bed_features['starts'].append(tr_start - 1)
+        bed_features['ends'].append(tr_end)
+        bed_features['names'].append(trName)
+        bed_features['strands'].append(strand)
+        bed_features['cds_starts'].append(cds_start)
+        bed_features['cds_ends'].append(cds_end)
+    bed_features['exon_offsets'] = np.cumsum(
+        [0] + [len(feature_exons) for feature_exons in exons])
+    exons = np.concatenate(exons) if len(exons) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    bed_features['exon_starts'] = annotation.exon_starts[exons] - 1
+    bed_features['exon_ends'] = annotation.exon_ends[exons]
+    return bed_features
+
+
+def format_bed12(bed_features, mergeTranscriptsAndOverlappingExons, ucsc):
+    """ Return the bed12 lines of the bed_features
+    (see get_bed12_features)"""
+    lines = []
+    exon_offsets = bed_features['exon_offsets'].tolist()
+    all_exon_starts = bed_features['exon_starts'].tolist()
+    all_exon_ends = bed_features['exon_ends'].tolist()
+    for k, (chrom, tr_start, tr_end, trName, strand, cds_start,
+            cds_end) in enumerate(zip(bed_features['chroms'],
+                                      bed_features['starts'],
+                                      bed_features['ends'],
+                                      bed_features['names'],
+                                      bed_features['strands'],
+                                      bed_features['cds_starts'],
+                                      bed_features['cds_ends'])):
         # Get all exons starts and lengths
+        starts = all_exon_starts[exon_offsets[k]:exon_offsets[k + 1]]
+        ends = all_exon_ends[exon_offsets[k]:exon_offsets[k + 1]]
         if mergeTranscriptsAndOverlappingExons:
             # We merge overlapping exons:
             exons_starts = []
             exons_length = []
             current_start = -1
             current_end = None
-            for e in db.children(tr, featuretype='exon', order_by='start'):
+            for start, end in zip(starts, ends):
                 if current_start == -1:
-                    current_start = e.start - 1
-                    current_end = e.end
+                    current_start = start
+                    current_end = end
                 else:
-                    if e.start > current_end:
+                    if start + 1 > current_end:
                         # This is a non-overlapping exon
                         # We store the previous exon:
                         exons_starts.append(current_start)
                         exons_length.append(current_end - current_start)
                         # We set the current:
-                        current_start = e.start - 1
-                        current_end = e.end
+                        current_start = start
+                        current_end = end
                     else:
                         # This is an overlapping exon
                         # We update current_end if necessary
-                        current_end = max(current_end, e.end)
+                        current_end = max(current_end, end)
             if current_start != -1:
                 # There is a last exon to store:
                 exons_starts.append(current_start)
                 exons_length.append(current_end - current_start)
         else:
-            exons_starts = [e.start - 1
-                            for e in
-                            db.children(tr, featuretype='exon',
-                                        order_by='start')]
-            exons_length = [len(e)
-                            for e in
-                            db.children(tr, featuretype='exon',
-                                        order_by='start')]
+            exons_starts = starts
+            exons_length = [end - start for start, end in zip(starts, ends)]
         # Rewrite the chromosome name if needed:
-        chrom = tr.chrom
         if ucsc and chrom[0:3] != 'chr':
             chrom = 'chr' + chrom
-        fo.write("%s\t%d\t%d\t%s\t%d\t%s\t%d\t%d\t%s\t%d\t%s\t%s\n" %
-                 (chrom, tr.start - 1, tr.end, trName, 0, tr.strand,
-                  cds_start, cds_end, "0", len(exons_starts),
-                  ",".join([str(ex_l) for ex_l in exons_length]),
-                  ",".join([str(s - (tr.start - 1)) for s in exons_starts])))
+        lines.append("%s\t%d\t%d\t%s\t%d\t%s\t%d\t%d\t%s\t%d\t%s\t%s\n" %
+                     (chrom, tr_start, tr_end, trName, 0, strand,
+                      cds_start, cds_end, "0", len(exons_starts),
+                      ",".join([str(ex_l) for ex_l in exons_length]),
+                      ",".join([str(s - tr_start) for s in exons_starts])))
+    return lines
+
+
+# GtfAnnotation of the workers of write_bed12 (shared with the parent by fork)
+workerAnnotation = None
+
+
+def initWorker(annotation):
+    global workerAnnotation
+    workerAnnotation = annotation
+
+
+def bed12_task(params):
+    """ Return the ranks (position in the output) of the features
+    (indices in the table of featuretype) of a chromosome and their
+    bed12 lines"""
+    (ranks, featuretype, features, prefered_name,
+     mergeTranscriptsAndOverlappingExons, ucsc) = params
+    if featuretype == 'transcript':
+        table = workerAnnotation.transcripts
+    else:
+        table = workerAnnotation.genes
+    bed_features = get_bed12_features(workerAnnotation, table, prefered_name,
+                                      features)
+    return ranks, format_bed12(bed_features,
+                               mergeTranscriptsAndOverlappingExons, ucsc)
+
+
+def gtf_key(fn):
+    """ Key of the gtf in the cache (content and version of the cache)"""
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(CACHE_VERSION.encode())
+    return h.hexdigest()
+
+
+def write_annotation_cache(annotation, entry_dir):
+    with open(os.path.join(entry_dir, 'annotation.pickle'), 'wb') as f:
+        pickle.dump(annotation, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_annotation_cache(entry_dir):
+    with open(os.path.join(entry_dir, 'annotation.pickle'), 'rb') as f:
+        return pickle.load(f)
+
+
+def evict_annotation_cache(cache_dir, max_size, keep):
+    """ Remove the least recently used entries of cache_dir
+    until its size is below max_size (in bytes). keep is never removed."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                   for f in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+    total_size = sum(e[1] for e in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        if entry_dir == keep:
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def read_annotation(fn, name_keys, cache_dir=None,
+                    max_cache_size=10000 * 1024 * 1024):
+    """ Return the GtfAnnotation of the gtf fn with the attributes
+    name_keys.
+    With a cache_dir, the annotation (with at least the DEFAULT_NAME_KEYS)
+    is stored in cache_dir and reused by the next runs on a gtf with the
+    same content whatever the options (the entry is rebuilt if a name
+    key is missing)."""
+    if cache_dir is None:
+        annotation = GtfAnnotation(name_keys)
+        annotation.read(fn)
+        return annotation
+    entry_dir = os.path.join(cache_dir, gtf_key(fn))
+    cached_keys = []
+    if os.path.isdir(entry_dir):
+        annotation = read_annotation_cache(entry_dir)
+        if all(key in annotation.name_keys for key in name_keys):
+            print("Using the cached annotation " + entry_dir,
+                  file=sys.stderr)
+            # Update the time of last use
+            os.utime(entry_dir)
+            return annotation
+        cached_keys = annotation.name_keys
+    annotation = GtfAnnotation(
+        DEFAULT_NAME_KEYS +
+        [key for key in cached_keys + name_keys
+         if key not in DEFAULT_NAME_KEYS])
+    annotation.read(fn)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # The entry is written in a temporary directory
+    # so other jobs never see an incomplete entry
+    tmp_entry_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    write_annotation_cache(annotation, tmp_entry_dir)
+    if os.path.isdir(entry_dir):
+        # The previous entry misses name keys
+        old_entry_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+        try:
+            os.rename(entry_dir, os.path.join(old_entry_dir, 'entry'))
+        except OSError:
+            pass
+        shutil.rmtree(old_entry_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_entry_dir, entry_dir)
+    except OSError:
+        # Another job stored the same entry in the meantime
+        shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+    evict_annotation_cache(cache_dir, max_cache_size, entry_dir)
+    return annotation
+
+
+def get_mode(mergeTranscripts, mergeTranscriptsAndOverlappingExons):
+    if mergeTranscriptsAndOverlappingExons:
+        return 'mergeTranscriptsAndOverlappingExons'
+    if mergeTranscripts:
+        return 'mergeTranscripts'
+    return 'transcripts'
+
+
+def get_prefered_name(preferedName, mode):
+    if preferedName is not None:
+        return preferedName
+    if mode == 'transcripts':
+        return "transcript_name"
+    return "gene_name"
+
+
+def write_bed12(annotation, fo, prefered_name, mode, ucsc, threads=1):
+    """ Write in fo the bed12 of the transcripts (mode 'transcripts') or
+    the genes (modes 'mergeTranscripts' and
+    'mergeTranscriptsAndOverlappingExons') of the annotation ordered by
+    start.
+    With threads > 1, the bed12 lines of each chromosome are
+    computed in parallel (by forked workers sharing the annotation)
+    and merged back in the same order."""
+    if mode == 'transcripts':
+        table = annotation.transcripts
+    else:
+        table = annotation.genes
+    merge_exons = mode == 'mergeTranscriptsAndOverlappingExons'
+    features = annotation.ordered_features(table)
+    if threads <= 1:
+        fo.writelines(format_bed12(
+            get_bed12_features(annotation, table, prefered_name, features),
+            merge_exons, ucsc))
+        return
+    # The exons are ordered before the fork so the workers share them
+    annotation.exon_order(table)
+    # One task per chromosome with the rank of each feature in the output
+    ranks_by_chrom = {}
+    for rank, i in enumerate(features):
+        ranks_by_chrom.setdefault(table.lines[i][1], []).append(rank)
+    tasks = [(ranks, table.featuretype, [features[rank] for rank in ranks],
+              prefered_name, merge_exons, ucsc)
+             for ranks in ranks_by_chrom.values()]
+    pool = multiprocessing.get_context('fork').Pool(
+        threads, initializer=initWorker, initargs=(annotation,))
+    try:
+        # The chromosomes with most features first
+        results = list(pool.imap_unordered(
+            bed12_task,
+            sorted(tasks, key=lambda task: len(task[0]), reverse=True)))
+    finally:
+        pool.close()
+        pool.join()
+    # The lines of each chromosome are ordered by rank
+    fo.writelines(line for _, line in heapq.merge(
+        *[zip(ranks, lines) for ranks, lines in results]))
+
+
+def convert_gtf_to_beds(fn, variants, ucsc, threads=1, cache_dir=None,
+                        max_cache_size=10000 * 1024 * 1024):
+    """ Read the gtf fn once and write the bed12 of each variant given as
+    (preferedName, mode, fo) (see write_bed12 for the modes)"""
+    name_keys = []
+    for preferedName, mode, _ in variants:
+        prefered_name = get_prefered_name(preferedName, mode)
+        if prefered_name not in name_keys:
+            name_keys.append(prefered_name)
+    annotation = read_annotation(fn, name_keys, cache_dir, max_cache_size)
+    for preferedName, mode, fo in variants:
+        write_bed12(annotation, fo, get_prefered_name(preferedName, mode),
+                    mode, ucsc, threads)
+
+
+def convert_gtf_to_bed(fn, fo, preferedName, mergeTranscripts,
+                       mergeTranscriptsAndOverlappingExons, ucsc, threads=1,
+                       cache_dir=None, max_cache_size=10000 * 1024 * 1024):
+    """ Write in fo the bed12 of the transcripts (or genes) of the gtf fn
+    ordered by start."""
+    mode = get_mode(mergeTranscripts, mergeTranscriptsAndOverlappingExons)
+    convert_gtf_to_beds(fn, [(preferedName, mode, fo)], ucsc, threads,
+                        cache_dir, max_cache_size)
 
 
 argp = argparse.ArgumentParser(
@@ -127,9 +660,9 @@ argp = argparse.ArgumentParser(
                  " per transcript/gene"))
 argp.add_argument('input', default=None,
                   help="Input gtf file (can be gzip).")
-argp.add_argument('--output', default=sys.stdout,
-                  type=argparse.FileType('w'),
-                  help="Output bed12 file.")
+argp.add_argument('--output', default=None,
+                  help=("Output bed12 file (default is stdout"
+                        " if there is no --variant)."))
 argp.add_argument('--ucscformat', action="store_true",
                   help="If you want that all chromosome names "
                        "begin with 'chr'.")
@@ -144,9 +677,48 @@ group.add_argument('--mergeTranscriptsAndOverlappingExons',
                    help="Merge all transcripts into a single "
                         "entry to have one line per gene and merge"
                         " overlapping exons.")
+argp.add_argument('--variant', default=[], action='append', nargs=3,
+                  metavar=('PREFEREDNAME', 'MODE', 'OUTPUT'),
+                  help=("Other bed12 written from the same gtf (can be"
+                        " repeated). PREFEREDNAME is the attribute used as"
+                        " name (or 'default'), MODE is transcripts,"
+                        " mergeTranscripts or"
+                        " mergeTranscriptsAndOverlappingExons."))
+argp.add_argument('--threads', default=1, type=int,
+                  help="Number of chromosomes processed in parallel.")
+argp.add_argument('--annotationCache', default=None,
+                  help=("Directory where the parsed gtfs are stored to be"
+                        " reused by the next runs on the same gtf"
+                        " (with any option)."))
+argp.add_argument('--annotationCacheSize', default=10000, type=int,
+                  help=("Maximum size in MB of the directory given in"
+                        " --annotationCache. The least recently used"
+                        " gtfs are removed above this size."))
 
 args = argp.parse_args()
-convert_gtf_to_bed(args.input, args.output, args.preferedName,
-                   args.mergeTranscripts,
-                   args.mergeTranscriptsAndOverlappingExons,
-                   args.ucscformat)
+mode = get_mode(args.mergeTranscripts,
+                args.mergeTranscriptsAndOverlappingExons)
+variants = []
+if args.output is not None:
+    variants.append((args.preferedName, mode, args.output))
+elif len(args.variant) == 0:
+    variants.append((args.preferedName, mode, None))
+for preferedName, variant_mode, output in args.variant:
+    if variant_mode not in BED12_MODES:
+        argp.error("The mode of --variant must be one of "
+                   + ", ".join(BED12_MODES) + ".")
+    variants.append((None if preferedName == 'default' else preferedName,
+                     variant_mode, output))
+files = [sys.stdout if output is None else open(output, 'w')
+         for _, _, output in variants]
+try:
+    convert_gtf_to_beds(args.input,
+                        [(preferedName, variant_mode, fo)
+                         for (preferedName, variant_mode, _), fo
+                         in zip(variants, files)],
+                        args.ucscformat, args.threads, args.annotationCache,
+                        args.annotationCacheSize * 1024 * 1024)
+finally:
+    for fo in files:
+        if fo is not sys.stdout:
+            fo.close()
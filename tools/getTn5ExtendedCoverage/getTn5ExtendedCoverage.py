@@ -1,35 +1,123 @@
 import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
 
 import pysam
 
 
+# Cut sites are read by chunks of this size
+cutSitesPerChunk = 100000
+
+
 # Inspired by bedtools
-def reportCoverage(chrName, starts, ends, fileout, lengthChrom):
-    """ Write in the fileout the coverage in bedgraph format"""
-    currentDepth = 0
-    lastStart = -1
-    lastDepth = -1
-    minindex = max(1, min(starts.keys()))
-    maxindex = min(lengthChrom-1, max(ends.keys()))
-    for i in range(minindex, maxindex):
-        if (i in starts):
-            currentDepth += starts[i]
-        if (currentDepth != lastDepth):
-            # The coverage changed
-            if (lastDepth > 0):
-                # Only non 0 regions are reported
-                fileout.write(chrName + "\t" + str(lastStart) + "\t" +
-                              str(i) + "\t" + str(lastDepth) + "\n")
-            # We update the parameters
-            lastStart = i
-            lastDepth = currentDepth
-        if (i in ends):
-            # We remove the ends to update in the next round
-            currentDepth -= ends[i]
-    # Print the last
-    if (lastDepth > 0):
-        fileout.write(chrName + "\t" + str(lastStart) + "\t" +
-                      str(maxindex+1) + "\t" + str(lastDepth) + "\n")
+class CoverageSweep(object):
+    """ Compute the coverage of a chromosome from the extended reads given
+    by chunks (see add) and give the regions with a non 0 coverage to
+    report(starts, ends, depths) as soon as they cannot change anymore.
+    The coverage is computed from the positions where it changes:
+    +1 at each start and -1 after each end.
+    Only the positions from minindex (the first start) to maxindex - 1
+    (maxindex is the last end) are evaluated and the last region goes until
+    the maxindex included.
+    Only the changes after the last reported region are kept in memory."""
+    def __init__(self, lengthChrom, report):
+        self.lengthChrom = lengthChrom
+        self.report = report
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.maxEnd = None
+        self.minindex = None
+        self.depth = 0
+        self.lastStart = None
+        self.lastDepth = -1
+
+    def add(self, starts, ends, frontier=None):
+        """ Add the first and the last positions of extended reads.
+        The starts and the ends of the next chunks are at least frontier.
+        frontier is None for the last chunk."""
+        self.starts = np.concatenate((self.starts, starts))
+        # The coverage decreases after the end
+        self.ends = np.concatenate((self.ends, ends + 1))
+        if len(ends) > 0:
+            maxEnd = int(ends.max())
+            if self.maxEnd is None or maxEnd > self.maxEnd:
+                self.maxEnd = maxEnd
+        if self.maxEnd is None:
+            return
+        maxindex = min(self.lengthChrom - 1, self.maxEnd)
+        if frontier is None:
+            self.sweep(maxindex)
+            if self.minindex is not None and maxindex > self.minindex and \
+               self.lastDepth > 0:
+                self.report(np.array([self.lastStart]),
+                            np.array([maxindex + 1]),
+                            np.array([self.lastDepth]))
+        else:
+            self.sweep(min(frontier, maxindex))
+
+    def sweep(self, limit):
+        """ Report the regions which end before limit"""
+        isBefore = self.starts < limit
+        starts = self.starts[isBefore]
+        self.starts = self.starts[~isBefore]
+        isBefore = self.ends < limit
+        ends = self.ends[isBefore]
+        self.ends = self.ends[~isBefore]
+        if self.minindex is None:
+            if len(starts) == 0:
+                # These ends are before the first start
+                return
+            self.minindex = int(starts.min())
+        ends = ends[ends > self.minindex]
+        positions, events = np.unique(np.concatenate((starts, ends)),
+                                      return_inverse=True)
+        if len(positions) == 0:
+            return
+        changes = np.concatenate((np.ones(len(starts), dtype=np.int64),
+                                  np.full(len(ends), -1, dtype=np.int64)))
+        depths = self.depth + \
+            np.cumsum(np.bincount(events, weights=changes,
+                                  minlength=len(positions)).astype(np.int64))
+        self.depth = int(depths[-1])
+        # A region starts where the depth is different from the previous one
+        regionStarts = np.empty(len(positions), dtype=bool)
+        regionStarts[0] = depths[0] != self.lastDepth
+        regionStarts[1:] = depths[1:] != depths[:-1]
+        positions = np.concatenate(([self.lastStart or 0],
+                                    positions[regionStarts]))
+        depths = np.concatenate(([self.lastDepth], depths[regionStarts]))
+        self.lastStart = int(positions[-1])
+        self.lastDepth = int(depths[-1])
+        # Only non 0 regions are reported
+        covered = depths[:-1] > 0
+        if np.any(covered):
+            self.report(positions[:-1][covered], positions[1:][covered],
+                        depths[:-1][covered])
+
+
+def reportCoverage(chrName, coverage, fileout):
+    """ Write in the fileout the coverage in bedgraph format
+    (the normalized coverage is written with 6 significant digits)"""
+    if coverage[2].dtype.kind == 'f':
+        lineFormat = "%s\t%i\t%i\t%.6g\n"
+    else:
+        lineFormat = "%s\t%i\t%i\t%i\n"
+    fileout.write("".join(lineFormat % (chrName, start, end, depth)
+                          for start, end, depth
+                          in zip(*[values.tolist() for values in coverage])))
+
+
+def reportCoverageInBigWig(chrName, coverage, bw):
+    """ Add the coverage to the pyBigWig file bw"""
+    starts, ends, depths = coverage
+    if len(starts) > 0:
+        bw.addEntries([chrName] * len(starts), starts, ends=ends,
+                      values=depths.astype(np.float64))
 
 
 def fiveP_shifted_oneB_read_start(read):
@@ -44,31 +132,376 @@ def fiveP_shifted_oneB_read_start(read):
         return read.reference_start+1+4
 
 
-def readBamAndComputeShiftedCoverage(inbam, outBed, l):
-    with open(outBed, 'w') as fo:
-        with pysam.AlignmentFile(inbam, 'rb') as bamfile:
-            gen = dict(zip(bamfile.references, bamfile.lengths))
-            for curChr in gen:
-                starts = {}
-                ends = {}
-                for read in bamfile.fetch(curChr):
-                    centralPos = fiveP_shifted_oneB_read_start(read)
-                    start = max(1, centralPos-lengthToExtend)
-                    end = min(centralPos+lengthToExtend-1, gen[curChr]-1)
-                    starts[start] = starts.setdefault(start, 0)+1
-                    ends[end] = ends.setdefault(end, 0)+1
-                if starts != {}:
-                    reportCoverage(curChr, starts, ends, fo, gen[curChr])
+def passReadFilters(read, excludeFlags, minMAPQ):
+    return not read.flag & excludeFlags and read.mapping_quality >= minMAPQ
+
+
+def shiftedCutSiteChunks(reads, chunkSize=cutSitesPerChunk, excludeFlags=0,
+                         minMAPQ=0, pairedFragments=False):
+    """ Yield the shifted 5' of the reads which have none of the excludeFlags
+    and a mapping quality of at least minMAPQ by arrays of chunkSize
+    with the start (0-based) of the first read which can still give
+    cut sites (None for the last array).
+    As the reads are sorted, the next cut sites are at least this start - 5.
+    With pairedFragments, only the primary reads of proper pairs are used.
+    The 2 reads of a pair are matched by name and the 2 cut sites of the
+    fragment (the shifted 5' of each read) are given when the second read
+    is found, if both reads pass the filters."""
+    centralPos = array('q')
+    # Reads waiting for their mate by name (in the order of the bam)
+    pendingReads = {}
+    for read in reads:
+        if pairedFragments:
+            if not read.is_proper_pair or read.is_secondary or \
+               read.is_supplementary:
+                continue
+            mate = pendingReads.pop(read.query_name, None)
+            if mate is None:
+                # Forget the reads whose mate should already have been found
+                while len(pendingReads) > 0:
+                    firstRead = next(iter(pendingReads.values()))
+                    if firstRead.next_reference_start >= read.reference_start:
+                        break
+                    del pendingReads[firstRead.query_name]
+                pendingReads[read.query_name] = read
+                continue
+            if not passReadFilters(mate, excludeFlags, minMAPQ) or \
+               not passReadFilters(read, excludeFlags, minMAPQ):
+                continue
+            centralPos.append(fiveP_shifted_oneB_read_start(mate))
+            centralPos.append(fiveP_shifted_oneB_read_start(read))
+        else:
+            if not passReadFilters(read, excludeFlags, minMAPQ):
+                continue
+            centralPos.append(fiveP_shifted_oneB_read_start(read))
+        if len(centralPos) >= chunkSize:
+            if len(pendingReads) > 0:
+                # The cut sites of the waiting reads are not given yet
+                firstStart = next(iter(pendingReads.values())).reference_start
+            else:
+                firstStart = read.reference_start
+            yield np.frombuffer(centralPos, dtype=np.int64), firstStart
+            centralPos = array('q')
+    yield np.frombuffer(centralPos, dtype=np.int64), None
+
+
+def readBedRegions(bedFile):
+    """ Return a dictionary where keys are chromosomes and values are
+    the starts and the ends of the merged regions of the bed file"""
+    regions = {}
+    with open(bedFile, 'r') as f:
+        for line in f:
+            v = line.split()
+            if len(v) < 3 or v[0].startswith(('#', 'track', 'browser')):
+                continue
+            regions.setdefault(v[0], []).append((int(v[1]), int(v[2])))
+    mergedRegions = {}
+    for chrom, chrRegions in regions.items():
+        merged = []
+        for start, end in sorted(chrRegions):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        merged = np.array(merged, dtype=np.int64)
+        mergedRegions[chrom] = (merged[:, 0], merged[:, 1])
+    return mergedRegions
+
+
+def isInRegions(positions, regions):
+    """ Return which 1-based positions are in the regions
+    (starts and ends of sorted non overlapping bed regions)"""
+    starts, ends = regions
+    i = np.searchsorted(starts, positions - 1, side='right') - 1
+    return (i >= 0) & (positions - 1 < ends[np.maximum(i, 0)])
+
+
+def computeShiftedCoverage(bamfile, curChr, lengthChrom, lengthToExtend,
+                           readFilters, report, blacklistRegions=None,
+                           peakRegions=None):
+    """ Give the coverage of curChr to report (see CoverageSweep)
+    using the reads which pass the readFilters (see shiftedCutSiteChunks)
+    and the cut sites which are not in the blacklistRegions.
+    Return the number of cut sites used and how many are in the peakRegions.
+    Regions are the starts and the ends given by readBedRegions.
+    The reads are read by chunks so the memory does not depend on the
+    number of reads of the chromosome."""
+    if blacklistRegions is not None and blacklistRegions[0][0] <= 0 and \
+       blacklistRegions[1][0] >= lengthChrom:
+        # The whole chromosome is excluded
+        return 0, 0
+    sweep = CoverageSweep(lengthChrom, report)
+    cutSites = 0
+    inPeaks = 0
+    for centralPos, lastReadStart in \
+            shiftedCutSiteChunks(bamfile.fetch(curChr), **readFilters):
+        if blacklistRegions is not None:
+            centralPos = centralPos[~isInRegions(centralPos,
+                                                 blacklistRegions)]
+        cutSites += len(centralPos)
+        if peakRegions is not None:
+            inPeaks += int(np.sum(isInRegions(centralPos, peakRegions)))
+        starts = np.maximum(1, centralPos - lengthToExtend)
+        ends = np.minimum(centralPos + lengthToExtend - 1, lengthChrom - 1)
+        if lastReadStart is None:
+            sweep.add(starts, ends)
+        else:
+            # The next extended reads start after this position
+            sweep.add(starts, ends, lastReadStart - 5 - lengthToExtend)
+    return cutSites, inPeaks
+
+
+def computeChromosomeTask(params):
+    """ Compute the coverage of a chromosome of a sample and write it
+    in a file of tmpDir (bedgraph if asText is True else the start, the end
+    and the depth of each region as int64).
+    Return (index of the sample, chromosome, file or None if there is no
+    coverage, number of cut sites, number of cut sites in the peaks)"""
+    (sampleIndex, inbam, curChr, lengthChrom, lengthToExtend, readFilters,
+     blacklistRegions, peakRegions, asText, tmpDir) = params
+    if asText:
+        fd, chrFile = tempfile.mkstemp(dir=tmpDir, suffix='.bedGraph')
+        fo = os.fdopen(fd, 'w')
+
+        def report(*coverage):
+            reportCoverage(curChr, coverage, fo)
+    else:
+        fd, chrFile = tempfile.mkstemp(dir=tmpDir, suffix='.regions')
+        fo = os.fdopen(fd, 'wb')
+
+        def report(*coverage):
+            np.stack(coverage, axis=1).astype(np.int64).tofile(fo)
+    with fo, pysam.AlignmentFile(inbam, 'rb') as bamfile:
+        cutSites, inPeaks = \
+            computeShiftedCoverage(bamfile, curChr, lengthChrom,
+                                   lengthToExtend, readFilters, report,
+                                   blacklistRegions, peakRegions)
+    if os.path.getsize(chrFile) == 0:
+        os.remove(chrFile)
+        chrFile = None
+    return sampleIndex, curChr, chrFile, cutSites, inPeaks
+
+
+def writeChromosomeTask(params, writer):
+    """ Compute the coverage of a chromosome of a sample and write it
+    directly with the CoverageWriter of the sample
+    (the previous chromosomes must be written).
+    Return like computeChromosomeTask"""
+    (sampleIndex, inbam, curChr, lengthChrom, lengthToExtend, readFilters,
+     blacklistRegions, peakRegions, asText, tmpDir) = params
+
+    def report(*coverage):
+        writer.writeCoverage(curChr, coverage)
+    with pysam.AlignmentFile(inbam, 'rb') as bamfile:
+        cutSites, inPeaks = \
+            computeShiftedCoverage(bamfile, curChr, lengthChrom,
+                                   lengthToExtend, readFilters, report,
+                                   blacklistRegions, peakRegions)
+    return sampleIndex, curChr, None, cutSites, inPeaks
+
+
+class CoverageWriter(object):
+    """ Write the coverage of the chromosomes of a sample in outFile
+    (bedgraph or bigwig with zoom levels) in the order of the bam header.
+    Without normalization, each chromosome is written as soon as the
+    previous ones are written. Else, the chromosomes are kept until all
+    of them are computed to get the scaling factor:
+    CPM: 1e6 / number of cut sites
+    RiP: 1e6 / number of cut sites in the peaks."""
+    def __init__(self, outFile, gen, outputFormat, normalization):
+        self.outFile = outFile
+        self.references = list(gen)
+        self.outputFormat = outputFormat
+        self.normalization = normalization
+        self.coverages = {}
+        self.nextChr = 0
+        self.cutSites = 0
+        self.cutSitesInPeaks = 0
+        if outputFormat == 'bigwig':
+            # pyBigWig is only needed for the bigwig output
+            import pyBigWig
+            self.fo = pyBigWig.open(outFile, 'w')
+            self.fo.addHeader(list(gen.items()), maxZooms=10)
+        else:
+            self.fo = open(outFile, 'w')
+
+    def add(self, curChr, chrFile, cutSites, cutSitesInPeaks):
+        """ Add a chromosome: a file written by computeChromosomeTask
+        or None if there is nothing to write"""
+        self.coverages[curChr] = chrFile
+        self.cutSites += cutSites
+        self.cutSitesInPeaks += cutSitesInPeaks
+        if self.normalization == 'none':
+            self.writeReady()
+
+    def writeReady(self, scale=None):
+        """ Write the chromosomes which are ready in order"""
+        while self.nextChr < len(self.references) and \
+                self.references[self.nextChr] in self.coverages:
+            curChr = self.references[self.nextChr]
+            self.write(curChr, self.coverages.pop(curChr), scale)
+            self.nextChr += 1
+
+    def write(self, curChr, chrFile, scale):
+        if chrFile is None:
+            return
+        if chrFile.endswith('.bedGraph'):
+            with open(chrFile, 'r') as fi:
+                shutil.copyfileobj(fi, self.fo)
+        else:
+            regions = np.memmap(chrFile, dtype=np.int64, mode='r')
+            regions = regions.reshape(-1, 3)
+            for i in range(0, len(regions), cutSitesPerChunk):
+                starts, ends, depths = np.array(
+                    regions[i:i + cutSitesPerChunk].T)
+                if scale is not None:
+                    depths = depths * scale
+                self.writeCoverage(curChr, (starts, ends, depths))
+            del regions
+        os.remove(chrFile)
+
+    def writeCoverage(self, curChr, coverage):
+        """ Write regions of curChr (see CoverageSweep) directly,
+        the previous chromosomes must be written"""
+        if self.outputFormat == 'bigwig':
+            reportCoverageInBigWig(curChr, coverage, self.fo)
+        else:
+            reportCoverage(curChr, coverage, self.fo)
+
+    def close(self):
+        if self.normalization == 'none':
+            scale = None
+        else:
+            if self.normalization == 'CPM':
+                total = self.cutSites
+            else:
+                total = self.cutSitesInPeaks
+            if total == 0 and self.cutSites > 0:
+                raise Exception("No cut site to normalize " + self.outFile)
+            scale = 1e6 / max(total, 1)
+        self.writeReady(scale)
+        self.fo.close()
+
+
+def readBamsAndComputeShiftedCoverage(inbams, outBeds, lengthToExtend,
+                                      threads=1, outputFormat='bedgraph',
+                                      readFilters=None, blacklist=None,
+                                      normalization='none', peaks=None):
+    """ Write in each outBed the coverage of each chromosome of the inbam
+    as bedgraph or as bigwig (with zoom levels, using the chromosome sizes
+    of the bam header).
+    The reads are filtered with readFilters (see shiftedCutSites)
+    and the cut sites in the blacklist (see readBedRegions) are excluded.
+    The coverage can be normalized (see CoverageWriter) using the cut sites
+    in the peaks (see readBedRegions) for RiP.
+    Each chromosome of each sample is a task. With threads > 1, the tasks
+    are processed in parallel (the longest chromosomes first).
+    The coverage is written as soon as it is computed (see CoverageSweep),
+    the chromosomes waiting to be written are in temporary files."""
+    if readFilters is None:
+        readFilters = {}
+    if blacklist is None:
+        blacklist = {}
+    if peaks is None:
+        peaks = {}
+    writers = []
+    tasks = []
+    # The coverage is given in files when it cannot be written directly
+    if threads > 1 or normalization != 'none':
+        tmpDir = tempfile.mkdtemp()
+    else:
+        tmpDir = None
+    asText = outputFormat == 'bedgraph' and normalization == 'none'
+    pool = None
+    try:
+        for sampleIndex, (inbam, outBed) in enumerate(zip(inbams, outBeds)):
+            with pysam.AlignmentFile(inbam, 'rb') as bamfile:
+                gen = dict(zip(bamfile.references, bamfile.lengths))
+            writers.append(CoverageWriter(outBed, gen, outputFormat,
+                                          normalization))
+            tasks += [(sampleIndex, inbam, curChr, gen[curChr],
+                       lengthToExtend, readFilters, blacklist.get(curChr),
+                       peaks.get(curChr), asText, tmpDir)
+                      for curChr in gen]
+        remainingTasks = [len(writer.references) for writer in writers]
+        if tmpDir is None:
+            results = (writeChromosomeTask(task, writers[task[0]])
+                       for task in tasks)
+        elif threads <= 1:
+            results = map(computeChromosomeTask, tasks)
+        else:
+            pool = multiprocessing.Pool(threads)
+            # The longest chromosomes first
+            results = pool.imap_unordered(
+                computeChromosomeTask,
+                sorted(tasks, key=lambda task: task[3], reverse=True))
+        for sampleIndex, curChr, chrFile, cutSites, inPeaks in results:
+            writers[sampleIndex].add(curChr, chrFile, cutSites, inPeaks)
+            remainingTasks[sampleIndex] -= 1
+            if remainingTasks[sampleIndex] == 0:
+                writers[sampleIndex].close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir, ignore_errors=True)
 
 
 argp = argparse.ArgumentParser(
     description=("compute coverage like bedtools"
                  " of 5' of reads shifted 4 or 5 bases"
                  " and extended of length."))
-argp.add_argument('--input', default=None,
-                  help="input indexed coordinates-sorted bam with alignement.")
+argp.add_argument('--input', default=None, nargs='+',
+                  help=("input indexed coordinates-sorted bam with alignement"
+                        " (or several bams)."))
 argp.add_argument('--length', default=None)
-argp.add_argument('--output', default=None)
+argp.add_argument('--output', default=None, nargs='+',
+                  help="output of each input bam.")
+argp.add_argument('--threads', default=1, type=int,
+                  help="Number of chromosomes processed in parallel.")
+argp.add_argument('--outputFormat', default='bedgraph',
+                  choices=['bedgraph', 'bigwig'],
+                  help=("bigwig writes directly a bigwig with zoom levels"
+                        " (needs pyBigWig)."))
+argp.add_argument('--excludeFlags', default=0, type=int,
+                  help=("Reads with any of these flags are not used"
+                        " (for example 1804: unmapped, mate unmapped,"
+                        " secondary, qc fail and duplicate)."))
+argp.add_argument('--minMAPQ', default=0, type=int,
+                  help="Minimum mapping quality of the reads used.")
+argp.add_argument('--blacklist', default=None,
+                  help=("Bed file with regions where the cut sites are not"
+                        " used (a region covering a whole chromosome like"
+                        " chrM skips this chromosome)."))
+argp.add_argument('--pairedFragments', action='store_true',
+                  help=("Only use proper pairs and count the 2 cut sites"
+                        " of each fragment (from the 2 reads, which must"
+                        " both pass the filters)."))
+argp.add_argument('--normalization', default='none',
+                  choices=['none', 'CPM', 'RiP'],
+                  help=("CPM multiplies the coverage by 1e6 / number of"
+                        " cut sites used, RiP by 1e6 / number of cut sites in"
+                        " --peaks (reads in peaks)."))
+argp.add_argument('--peaks', default=None,
+                  help="Bed file with the peaks for --normalization RiP.")
 args = argp.parse_args()
+if args.output is None or len(args.input) != len(args.output):
+    argp.error("--output needs one file for each --input.")
+if args.normalization == 'RiP' and args.peaks is None:
+    argp.error("--normalization RiP needs --peaks.")
 lengthToExtend = int(args.length)
-readBamAndComputeShiftedCoverage(args.input, args.output, lengthToExtend)
+readFilters = {'excludeFlags': args.excludeFlags,
+               'minMAPQ': args.minMAPQ,
+               'pairedFragments': args.pairedFragments}
+if args.blacklist is None:
+    blacklist = {}
+else:
+    blacklist = readBedRegions(args.blacklist)
+if args.peaks is None:
+    peaks = {}
+else:
+    peaks = readBedRegions(args.peaks)
+readBamsAndComputeShiftedCoverage(args.input, args.output, lengthToExtend,
+                                  args.threads, args.outputFormat,
+                                  readFilters, blacklist,
+                                  args.normalization, peaks)
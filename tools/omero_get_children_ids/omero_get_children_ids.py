@@ -1,7 +1,78 @@
 import argparse
+import collections
+import concurrent.futures
+import hashlib
 import json
+import os
+import re
+import tempfile
+import threading
+import time
 
 from omero.gateway import BlitzGateway
+from omero.rtypes import unwrap
+from omero.sys import ParametersI
+
+# Number of rows fetched by each projection query
+DEFAULT_PAGE_SIZE = 10000
+
+# Version of the entries of ChildrenCache
+CACHE_VERSION = 2
+# Iterations of the hash of the password in the entries of ChildrenCache
+CREDENTIALS_HASH_ITERATIONS = 100000
+
+# HQL projections giving (id, name) of the final objects of a parent :id
+# The order follows the one of listChildren (children by name for links)
+# Wells have no name (None like WellWrapper.getName())
+HIERARCHY_QUERIES = {
+    ("project", "dataset"):
+        "select d.id, d.name from ProjectDatasetLink l join l.child d"
+        " where l.parent.id = :id order by d.name, d.id",
+    ("project", "image"):
+        "select i.id, i.name from ProjectDatasetLink pl join pl.child d,"
+        " DatasetImageLink dl join dl.child i"
+        " where pl.parent.id = :id and dl.parent.id = d.id"
+        " order by d.name, d.id, i.name, i.id",
+    ("dataset", "image"):
+        "select i.id, i.name from DatasetImageLink l join l.child i"
+        " where l.parent.id = :id order by i.name, i.id",
+    ("screen", "plate"):
+        "select p.id, p.name from ScreenPlateLink l join l.child p"
+        " where l.parent.id = :id order by p.name, p.id",
+    ("screen", "well"):
+        "select w.id from ScreenPlateLink l join l.child p, Well w"
+        " where l.parent.id = :id and w.plate.id = p.id"
+        " order by p.name, p.id, w.row, w.column, w.id",
+    ("screen", "image"):
+        "select i.id, i.name from ScreenPlateLink l join l.child p,"
+        " Well w join w.wellSamples ws join ws.image i"
+        " where l.parent.id = :id and w.plate.id = p.id"
+        " order by p.name, p.id, w.row, w.column, w.id, ws.id",
+    ("plate", "well"):
+        "select w.id from Well w where w.plate.id = :id"
+        " order by w.row, w.column, w.id",
+    ("plate", "image"):
+        "select i.id, i.name from Well w join w.wellSamples ws"
+        " join ws.image i where w.plate.id = :id"
+        " order by w.row, w.column, w.id, ws.id",
+    ("well", "image"):
+        "select i.id, i.name from WellSample ws join ws.image i"
+        " where ws.well.id = :id order by ws.id",
+}
+
+# Aliases of the objects in the from clause of HIERARCHY_QUERIES
+QUERY_ALIAS = re.compile(r"(?:from|join|,)\s+[\w.]+\s+(\w+)")
+
+# Type of the children of each type (WellSamples are replaced by their
+# image like in iter_children_recursive) and projection to get them
+CHILD_QUERIES = {
+    parent_type: (child_type, HIERARCHY_QUERIES[(parent_type, child_type)])
+    for parent_type, child_type in [("project", "dataset"),
+                                    ("dataset", "image"),
+                                    ("screen", "plate"),
+                                    ("plate", "well"),
+                                    ("well", "image")]
+}
 
 
 def get_omero_credentials(config_file):
@@ -20,45 +91,411 @@ def get_omero_credentials(config_file):
     return (omero_username, omero_password)
 
 
-def recursive_get_children_id(parent_object, final_object_type, get_name):
-    output = []
+def iter_children_recursive(parent_object, final_object_type):
+    """Yield (id, name) of the final objects below parent_object
+    with listChildren (one call per container)"""
     if parent_object.OMERO_CLASS == 'WellSample':
-        if get_name:
-            parent_image = parent_object.getImage()
-            return [f"{parent_image.id}\t{parent_image.getName()}"]
-        else:
-            return [parent_object.getImage().id]
+        parent_image = parent_object.getImage()
+        yield parent_image.id, parent_image.getName()
+        return
     for children in parent_object.listChildren():
         if children.OMERO_CLASS == final_object_type.title():
-            if get_name:
-                output.append(f"{children.id}\t{children.getName()}")
-            else:
-                output.append(children.id)
+            yield children.id, children.getName()
         else:
             # We need to go one step further
-            output += recursive_get_children_id(
-                children, final_object_type, get_name
-            )
-    return output
-
-
-def get_children_ids(parent_object_type,
-                     omero_id,
-                     final_object_type,
-                     get_name,
-                     omero_username,
-                     omero_password,
-                     omero_host="idr.openmicroscopy.org",
-                     omero_secured=False):
+            yield from iter_children_recursive(children, final_object_type)
+
+
+def iter_projection(query_service, query, parent_id, page_size):
+    """Yield (id, name) of the rows of the query with :id = parent_id
+    fetched by pages of page_size rows"""
+    offset = 0
+    while True:
+        rows = query_service.projection(query, parent_id, offset, page_size)
+        for row in rows:
+            yield row[0], row[1] if len(row) > 1 else None
+        if len(rows) < page_size:
+            break
+        offset += len(rows)
+
+
+class OmeroQueryService:
+    """Run the paged projections of HierarchyResolver and
+    ParallelTraversal with the query service of a BlitzGateway
+    connection"""
+    def __init__(self, conn):
+        self.query_service = conn.getQueryService()
+        self.ctx = conn.SERVICE_OPTS
+
+    def projection(self, query, parent_id, offset, limit):
+        """Return the rows [offset, offset + limit) of the query
+        with :id = parent_id as lists of python values"""
+        params = ParametersI()
+        params.addId(parent_id)
+        params.page(offset, limit)
+        return [[unwrap(value) for value in row]
+                for row in self.query_service.projection(query, params,
+                                                         self.ctx)]
+
+
+class HierarchyResolver:
+    """Get the ids (and names) of the children of a parent object
+    with a few paged projection queries (no wrapper is loaded).
+    query_service needs a method projection(query, parent_id, offset,
+    limit) (see OmeroQueryService) so it can be replaced by a stand-in."""
+    def __init__(self, query_service, page_size=DEFAULT_PAGE_SIZE):
+        self.query_service = query_service
+        self.page_size = page_size
+
+    @staticmethod
+    def can_resolve(parent_object_type, final_object_type):
+        return (parent_object_type.lower(),
+                final_object_type.lower()) in HIERARCHY_QUERIES
+
+    def iter_children(self, parent_object_type, omero_id, final_object_type):
+        """Yield (id, name) of the final objects of the parent object"""
+        query = HIERARCHY_QUERIES[(parent_object_type.lower(),
+                                   final_object_type.lower())]
+        return iter_projection(self.query_service, query, omero_id,
+                               self.page_size)
+
+
+class ParallelTraversal:
+    """Get the ids (and names) of the children of a parent object
+    level by level with paged projections (see CHILD_QUERIES).
+    The containers below the parent object are listed in the main thread
+    down to the first level from which the final objects are given by one
+    query of HIERARCHY_QUERIES (plates for the images of a screen).
+    The final objects of each of these containers are fetched by a pool of
+    workers, each with its own query service given by
+    query_service_factory (sessions joining the login of the main one).
+    The results are yielded in order as soon as they are available and at
+    most 2 x workers parents are pending, so the memory is bounded."""
+    def __init__(self, query_service, query_service_factory,
+                 page_size=DEFAULT_PAGE_SIZE, workers=4):
+        self.query_service = query_service
+        self.query_service_factory = query_service_factory
+        self.page_size = page_size
+        self.workers = workers
+        self.local = threading.local()
+
+    @staticmethod
+    def can_traverse(parent_object_type, final_object_type):
+        object_type = parent_object_type.lower()
+        while object_type in CHILD_QUERIES:
+            object_type = CHILD_QUERIES[object_type][0]
+            if object_type == final_object_type.lower():
+                return True
+        return False
+
+    def iter_parents(self, object_type, object_id, final_object_type):
+        """Yield (type, id) of the highest containers below object_id
+        whose final objects are given by one query of HIERARCHY_QUERIES
+        (object_id itself if its children are the final objects)"""
+        child_type, query = CHILD_QUERIES[object_type]
+        if child_type == final_object_type:
+            yield object_type, object_id
+            return
+        for child_id, _ in iter_projection(self.query_service, query,
+                                           object_id, self.page_size):
+            if (child_type, final_object_type) in HIERARCHY_QUERIES:
+                yield child_type, child_id
+            else:
+                yield from self.iter_parents(child_type, child_id,
+                                             final_object_type)
+
+    def get_final_children(self, object_type, object_id, final_object_type):
+        """List the final objects of object_id in a worker
+        (with the query service of the worker)"""
+        if not hasattr(self.local, "query_service"):
+            self.local.query_service = self.query_service_factory()
+        return list(iter_projection(
+            self.local.query_service,
+            HIERARCHY_QUERIES[(object_type, final_object_type)],
+            object_id, self.page_size))
+
+    def iter_children(self, parent_object_type, omero_id, final_object_type):
+        """Yield (id, name) of the final objects of the parent object"""
+        final_object_type = final_object_type.lower()
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for object_type, object_id in self.iter_parents(
+                    parent_object_type.lower(), omero_id, final_object_type):
+                pending.append(pool.submit(self.get_final_children,
+                                           object_type, object_id,
+                                           final_object_type))
+                if len(pending) >= 2 * self.workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+
+def signature_query(query):
+    """Projection giving the number of final objects of a query of
+    HIERARCHY_QUERIES, the last update event among them and, for the other
+    objects of the query (links, well samples...), the sum of their ids,
+    which changes when a final object is replaced by another one, and
+    their last update event (a renamed dataset changes the order)"""
+    select_clause = query[len("select "):query.index(" from ")]
+    alias = select_clause.split(".")[0]
+    from_clause = query[query.index(" from "):query.index(" order by ")]
+    where = from_clause.index(" where ")
+    other_aliases = [other for other in QUERY_ALIAS.findall(
+                     from_clause[:where]) if other != alias]
+    return (f"select count({alias}.id),"
+            f" max({alias}.details.updateEvent.id)"
+            + "".join(f", sum({other}.id),"
+                      f" max({other}.details.updateEvent.id)"
+                      for other in other_aliases)
+            + from_clause)
+
+
+def get_parent_update_event(query_service, parent_object_type, omero_id):
+    """Return the last update event of the parent object
+    (raise an Exception if it does not exist or is not visible)"""
+    parent_query = (f"select o.details.updateEvent.id from"
+                    f" {parent_object_type.title()} o where o.id = :id")
+    rows = query_service.projection(parent_query, omero_id, 0, 1)
+    if len(rows) == 0:
+        raise Exception(f"{parent_object_type.title()} {omero_id} does not"
+                        " exist or is not visible.")
+    return rows[0][0]
+
+
+def get_signature(query_service, parent_object_type, omero_id,
+                  final_object_type):
+    """Return the last update event of the parent object,
+    the number of final objects and their last update event
+    (any change of the children changes the signature)"""
+    query = HIERARCHY_QUERIES[(parent_object_type.lower(),
+                               final_object_type.lower())]
+    rows = query_service.projection(signature_query(query), omero_id, 0, 1)
+    return [get_parent_update_event(query_service, parent_object_type,
+                                    omero_id)] + \
+        [value for row in rows for value in row]
+
+
+class ChildrenCache:
+    """Children of parent objects stored in cache_dir, one json lines file
+    per (host, user, password, parent type, id, final type, get_name) with
+    the signature of the parent (see get_signature) in the first line.
+    An entry is reused without login during ttl seconds after it was written
+    or checked. After, it is reused if the signature did not change.
+    The entries checked the least recently are removed to keep the size of
+    cache_dir below max_size bytes."""
+    def __init__(self, cache_dir, ttl=24 * 3600, max_size=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def entry(self, omero_host, omero_username, omero_password, *key):
+        """Path of the entry of the key for these credentials.
+        It depends on a slow hash of the password so the entries, which are
+        used without login, are only found by those who know it."""
+        credentials = hashlib.pbkdf2_hmac(
+            "sha256", omero_password.encode(),
+            json.dumps([omero_host, omero_username]).encode(),
+            CREDENTIALS_HASH_ITERATIONS
+        ).hex()
+        h = hashlib.sha256(json.dumps([CACHE_VERSION, omero_host,
+                                       omero_username, credentials,
+                                       *key]).encode())
+        return os.path.join(self.cache_dir, h.hexdigest() + ".jsonl")
+
+    def is_fresh(self, entry):
+        return os.path.exists(entry) and \
+            time.time() - os.path.getmtime(entry) < self.ttl
+
+    def get_signature(self, entry):
+        """Return the signature of the entry (None if missing)"""
+        try:
+            with open(entry) as f:
+                return json.loads(f.readline())["signature"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def refresh(self, entry):
+        # The signature was checked
+        os.utime(entry)
+
+    def iter_children(self, entry):
+        with open(entry) as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    def store(self, entry, signature, children):
+        """Yield the children while they are written in entry.
+        The entry is only created once all children were written
+        (in a temporary file before so other jobs never see an incomplete
+        entry)"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_entry = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp")
+        complete = False
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps({"signature": signature}) + "\n")
+                for child in children:
+                    f.write(json.dumps(child) + "\n")
+                    yield child
+            os.replace(tmp_entry, entry)
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp_entry)
+        self.evict(entry)
+
+    def evict(self, keep):
+        """Remove the least recently checked entries until the size of
+        cache_dir is below max_size. keep is never removed."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not name.endswith(".jsonl"):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry),
+                                os.path.getsize(entry), entry))
+            except OSError:
+                # Removed by another job
+                pass
+        total_size = sum(e[1] for e in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def format_child(child_id, name, get_name):
+    if get_name:
+        return f"{child_id}\t{name}"
+    return child_id
+
+
+def write_children_ids(fo, parent_object_type, omero_id, final_object_type,
+                       get_name, omero_username, omero_password,
+                       omero_host="idr.openmicroscopy.org",
+                       omero_secured=False, page_size=DEFAULT_PAGE_SIZE,
+                       strategy="query", workers=4, cache=None):
+    """Write in fo one line per child as soon as it is found:
+    - strategy query: one projection query (see HIERARCHY_QUERIES),
+    - strategy traversal: the hierarchy is traversed level by level with
+    workers sessions (see ParallelTraversal),
+    - for other types: listChildren of the objects.
+    With a ChildrenCache, the children are taken from the cache when
+    possible (see iter_children_ids).
+    """
+    n_children = 0
+    for child in iter_children_ids(parent_object_type, omero_id,
+                                   final_object_type, get_name,
+                                   omero_username, omero_password,
+                                   omero_host, omero_secured, page_size,
+                                   strategy, workers, cache):
+        fo.write(f"{child}\n")
+        n_children += 1
+    if n_children == 0:
+        fo.write('\n')
+
+
+def iter_children_ids(parent_object_type,
+                      omero_id,
+                      final_object_type,
+                      get_name,
+                      omero_username,
+                      omero_password,
+                      omero_host="idr.openmicroscopy.org",
+                      omero_secured=False,
+                      page_size=DEFAULT_PAGE_SIZE,
+                      strategy="query",
+                      workers=4,
+                      cache=None):
+    """Yield the children (ids or ids and names).
+    With a ChildrenCache, a fresh entry is used without login, an entry
+    older than the ttl is used if the signature of the parent did not
+    change and the entry is (re)written otherwise."""
+    entry = None
+    if cache is not None:
+        entry = cache.entry(omero_host, omero_username, omero_password,
+                            parent_object_type.lower(), omero_id,
+                            final_object_type.lower(), get_name)
+        if cache.is_fresh(entry):
+            yield from cache.iter_children(entry)
+            return
     # Connect to omero:
     with BlitzGateway(
         omero_username, omero_password, host=omero_host, secure=omero_secured
     ) as conn:
-        # Retrieve omero object
-        parent_object = conn.getObject(parent_object_type.title(), omero_id)
-        return recursive_get_children_id(
-            parent_object, final_object_type, get_name
-        )
+        signature = None
+        if cache is not None and \
+           HierarchyResolver.can_resolve(parent_object_type,
+                                         final_object_type):
+            signature = get_signature(OmeroQueryService(conn),
+                                      parent_object_type, omero_id,
+                                      final_object_type)
+            if signature == cache.get_signature(entry):
+                cache.refresh(entry)
+                yield from cache.iter_children(entry)
+                return
+        elif HierarchyResolver.can_resolve(parent_object_type,
+                                           final_object_type):
+            # The queries give no children for a missing parent
+            get_parent_update_event(OmeroQueryService(conn),
+                                    parent_object_type, omero_id)
+        worker_conns = []
+
+        def worker_query_service():
+            # A new session joining the login of conn
+            worker_conn = BlitzGateway(host=omero_host, secure=omero_secured)
+            if not worker_conn.connect(
+                    sUuid=conn.getSession().getUuid().val):
+                raise Exception("Connect failed: a worker could not join"
+                                f" the session on {omero_host}.")
+            worker_conns.append(worker_conn)
+            return OmeroQueryService(worker_conn)
+
+        if strategy == "traversal" and \
+           ParallelTraversal.can_traverse(parent_object_type,
+                                          final_object_type):
+            children = ParallelTraversal(
+                OmeroQueryService(conn), worker_query_service, page_size,
+                workers
+            ).iter_children(parent_object_type, omero_id, final_object_type)
+        elif HierarchyResolver.can_resolve(parent_object_type,
+                                           final_object_type):
+            # Projection queries on the ids
+            children = HierarchyResolver(
+                OmeroQueryService(conn), page_size
+            ).iter_children(parent_object_type, omero_id, final_object_type)
+        else:
+            # Retrieve omero object
+            parent_object = conn.getObject(parent_object_type.title(),
+                                           omero_id)
+            if parent_object is None:
+                raise Exception(f"{parent_object_type.title()} {omero_id}"
+                                " does not exist or is not visible.")
+            children = iter_children_recursive(parent_object,
+                                               final_object_type)
+        children = (format_child(child_id, name, get_name)
+                    for child_id, name in children)
+        if cache is not None:
+            children = cache.store(entry, signature, children)
+        try:
+            yield from children
+        finally:
+            for worker_conn in worker_conns:
+                # The session is shared with conn
+                worker_conn.close(hard=False)
+
+
+def get_children_ids(*args, **kwargs):
+    """List of the children (ids or ids and names), see iter_children_ids"""
+    return list(iter_children_ids(*args, **kwargs))
 
 
 if __name__ == "__main__":
@@ -77,16 +514,43 @@ if __name__ == "__main__":
     p.add_argument("--get-name", dest="get_name",
                    action="store_true", default=False)
     p.add_argument("--output", type=str, default=None, required=True)
+    p.add_argument("--page-size", dest="page_size", type=int,
+                   default=DEFAULT_PAGE_SIZE,
+                   help="Number of rows fetched by each query")
+    p.add_argument("--strategy", choices=["query", "traversal"],
+                   default="query",
+                   help="query: one projection query, traversal: level by"
+                        " level with --workers sessions")
+    p.add_argument("--workers", type=int, default=4,
+                   help="Number of sessions of the traversal strategy")
+    p.add_argument("--cache-dir", dest="cache_dir", default=None,
+                   help="Directory where the children are kept for the"
+                        " next runs (no cache by default)")
+    p.add_argument("--cache-ttl", dest="cache_ttl", type=float,
+                   default=24,
+                   help="Hours during which the cached children are used"
+                        " without login (after, they are used if the parent"
+                        " and its children were not updated)")
+    p.add_argument("--cache-size", dest="cache_size", type=float,
+                   default=100,
+                   help="Maximum size of the cache directory in MB")
     args = p.parse_args()
-    children_ids = get_children_ids(
-        args.parent_object_type,
-        args.omero_id,
-        args.final_object_type,
-        args.get_name,
-        *get_omero_credentials(args.config_file),
-        omero_host=args.omero_host,
-        omero_secured=args.omero_secured,
-    )
+    cache = None
+    if args.cache_dir is not None:
+        cache = ChildrenCache(args.cache_dir, args.cache_ttl * 3600,
+                              args.cache_size * 1024 * 1024)
     with open(args.output, 'w') as fo:
-        fo.write('\n'.join([str(id) for id in children_ids]))
-        fo.write('\n')
+        write_children_ids(
+            fo,
+            args.parent_object_type,
+            args.omero_id,
+            args.final_object_type,
+            args.get_name,
+            *get_omero_credentials(args.config_file),
+            omero_host=args.omero_host,
+            omero_secured=args.omero_secured,
+            page_size=args.page_size,
+            strategy=args.strategy,
+            workers=args.workers,
+            cache=cache,
+        )
@@ -8,7 +8,8 @@ import numpy as np
 
 import omero
 from omero.gateway import BlitzGateway
-from omero.rtypes import rdouble, rstring
+from omero.rtypes import rdouble, rstring, unwrap
+from omero.sys import ParametersI
 
 import pandas as pd
 
@@ -55,217 +56,212 @@ def get_omero_credentials(config_file):
     return (omero_username, omero_password)
 
 
-def clean(image_id, omero_username, omero_password, omero_host, omero_secured,
-          verbose):
-    with BlitzGateway(
-        omero_username, omero_password, host=omero_host, secure=omero_secured
-    ) as conn:
-        roi_service = conn.getRoiService()
-        img = conn.getObject("Image", image_id)
-        rois = roi_service.findByImage(image_id, None, conn.SERVICE_OPTS).rois
-        # Delete existing rois
-        if len(rois) > 0:
-            if verbose:
-                print(f"Removing {len(rois)} existing ROIs.")
-            conn.deleteObjects("Roi", [roi.getId().val
-                                       for roi
-                                       in rois],
-                               wait=True)
-        # Delete existing table named Results_from_Fiji
-        for ann in img.listAnnotations():
-            if ann.OMERO_TYPE == omero.model.FileAnnotationI:
-                if ann.getFileName() == "Results_from_Fiji":
-                    if verbose:
-                        print("Removing the table Results_from_Fiji.")
-                    conn.deleteObjects("OriginalFile", [ann.getFile().id],
-                                       wait=True)
-
-
-def upload(
-    image_id,
-    df,
-    roi_files,
-    omero_username,
-    omero_password,
-    omero_host,
-    omero_secured,
-    verbose,
-):
-    with BlitzGateway(
-        omero_username, omero_password, host=omero_host, secure=omero_secured
-    ) as conn:
-        updateService = conn.getUpdateService()
-        img = conn.getObject("Image", image_id)
-        # Create ROIs:
-        roi_ids = []
-        # roi_big_circle_ids = []
-        # roi_spine_ids = []
-        for i, ro_file in enumerate(roi_files):
-            # Create a polygon
-            my_poly = omero.model.PolygonI()
-            # Add the coordinates
-            with open(ro_file, "r") as f:
-                coos = f.readlines()
-            coos_formatted = ", ".join([line.strip().replace("\t", ",")
-                                        for line in coos])
-            my_poly.setPoints(rstring(coos_formatted))
-            # Add a name
-            my_poly.setTextValue(rstring("ROI" + str(i)))
-            # Create a omero ROI
-            my_new_roi = omero.model.RoiI()
-            my_new_roi.addShape(my_poly)
-            # Attach it to the image
-            my_new_roi.setImage(img._obj)
-            my_new_roi = updateService.saveAndReturnObject(my_new_roi)
-            roi_ids.append(my_new_roi.getId().val)
-            if verbose:
-                print(f"Created ROI{i} {my_new_roi.getId().val}.")
-            # Check if there is an elongation ROI associated:
-            if os.path.exists(ro_file.replace("roi_coordinates",
-                                              "elongation_rois")):
-                # Get the coordinates
-                with open(
-                    ro_file.replace("roi_coordinates", "elongation_rois"),
-                    "r"
-                ) as f:
-                    all_coos = f.readlines()
-                # Get the circles coos
-                circles_coos = [line for line in all_coos
-                                if len(line.split("\t")) == 3]
-                for j, circle_coo in enumerate(circles_coos):
-                    # Create an ellipse
-                    my_ellipse = omero.model.EllipseI()
-                    # Get the characteristics from text file
-                    xleft, ytop, width = [
-                        float(v) for v in circle_coo.strip().split("\t")
+def clean(conn, image_id, verbose):
+    roi_service = conn.getRoiService()
+    img = conn.getObject("Image", image_id)
+    rois = roi_service.findByImage(image_id, None, conn.SERVICE_OPTS).rois
+    # Delete existing rois
+    if len(rois) > 0:
+        if verbose:
+            print(f"Removing {len(rois)} existing ROIs.")
+        conn.deleteObjects("Roi", [roi.getId().val
+                                   for roi
+                                   in rois],
+                           wait=True)
+    # Delete existing table named Results_from_Fiji
+    for ann in img.listAnnotations():
+        if ann.OMERO_TYPE == omero.model.FileAnnotationI:
+            if ann.getFileName() == "Results_from_Fiji":
+                if verbose:
+                    print("Removing the table Results_from_Fiji.")
+                conn.deleteObjects("OriginalFile", [ann.getFile().id],
+                                   wait=True)
+
+
+def new_roi(shape, image):
+    # Create a omero ROI
+    roi = omero.model.RoiI()
+    roi.addShape(shape)
+    # Attach it to the image
+    roi.setImage(image)
+    return roi
+
+
+def build_rois(image_id, roi_files):
+    """Return the ROIs of the roi_files (not saved) as a list of
+    (description, roi) and the indices of the polygon of each file
+    in this list"""
+    # Unloaded image (no need to get it from the server)
+    image = omero.model.ImageI(image_id, False)
+    rois = []
+    polygon_indices = []
+    for i, ro_file in enumerate(roi_files):
+        # Create a polygon
+        my_poly = omero.model.PolygonI()
+        # Add the coordinates
+        with open(ro_file, "r") as f:
+            coos = f.readlines()
+        coos_formatted = ", ".join([line.strip().replace("\t", ",")
+                                    for line in coos])
+        my_poly.setPoints(rstring(coos_formatted))
+        # Add a name
+        my_poly.setTextValue(rstring("ROI" + str(i)))
+        polygon_indices.append(len(rois))
+        rois.append((f"ROI{i}", new_roi(my_poly, image)))
+        # Check if there is an elongation ROI associated:
+        if os.path.exists(ro_file.replace("roi_coordinates",
+                                          "elongation_rois")):
+            # Get the coordinates
+            with open(
+                ro_file.replace("roi_coordinates", "elongation_rois"),
+                "r"
+            ) as f:
+                all_coos = f.readlines()
+            # Get the circles coos
+            circles_coos = [line for line in all_coos
+                            if len(line.split("\t")) == 3]
+            for j, circle_coo in enumerate(circles_coos):
+                # Create an ellipse
+                my_ellipse = omero.model.EllipseI()
+                # Get the characteristics from text file
+                xleft, ytop, width = [
+                    float(v) for v in circle_coo.strip().split("\t")
+                ]
+                # Add it to the ellipse
+                my_ellipse.setRadiusX(rdouble(width / 2.0))
+                my_ellipse.setRadiusY(rdouble(width / 2.0))
+                my_ellipse.setX(rdouble(xleft + width / 2))
+                my_ellipse.setY(rdouble(ytop + width / 2))
+                # Add a name
+                my_ellipse.setTextValue(
+                    rstring("inscribedCircle" + str(i) + "_" + str(j))
+                )
+                rois.append((f"ROI inscribedCircle {i}_{j}",
+                             new_roi(my_ellipse, image)))
+            if len(all_coos) > len(circles_coos):
+                # Create a polyline for the spine
+                my_poly = omero.model.PolylineI()
+                coos_formatted = ", ".join(
+                    [
+                        line.strip().replace("\t", ",")
+                        for line in all_coos[len(circles_coos):]
                     ]
-                    # Add it to the ellipse
-                    my_ellipse.setRadiusX(rdouble(width / 2.0))
-                    my_ellipse.setRadiusY(rdouble(width / 2.0))
-                    my_ellipse.setX(rdouble(xleft + width / 2))
-                    my_ellipse.setY(rdouble(ytop + width / 2))
-                    # Add a name
-                    my_ellipse.setTextValue(
-                        rstring("inscribedCircle" + str(i) + "_" + str(j))
-                    )
-                    # Create a omero ROI
-                    my_new_roi = omero.model.RoiI()
-                    my_new_roi.addShape(my_ellipse)
-                    # Attach it to the image
-                    my_new_roi.setImage(img._obj)
-                    my_new_roi = updateService.saveAndReturnObject(my_new_roi)
-                    if verbose:
-                        print(
-                            f"Created ROI inscribedCircle {i}_{j}:"
-                            f"{my_new_roi.getId().val}."
-                        )
-                    # I store the id of the first circle:
-                    # if j == 0:
-                    #     roi_big_circle_ids.append(my_new_roi.getId().val)
-                if len(all_coos) > len(circles_coos):
-                    # Create a polyline for the spine
-                    my_poly = omero.model.PolylineI()
-                    coos_formatted = ", ".join(
-                        [
-                            line.strip().replace("\t", ",")
-                            for line in all_coos[len(circles_coos):]
-                        ]
-                    )
-                    my_poly.setPoints(rstring(coos_formatted))
-                    # Add a name
-                    my_poly.setTextValue(rstring("spine" + str(i)))
-                    # Create a omero ROI
-                    my_new_roi = omero.model.RoiI()
-                    my_new_roi.addShape(my_poly)
-                    # Attach it to the image
-                    my_new_roi.setImage(img._obj)
-                    my_new_roi = updateService.saveAndReturnObject(my_new_roi)
-                    if verbose:
-                        print(f"Created ROI spine{i}:"
-                              f" {my_new_roi.getId().val}.")
-                    # roi_spine_ids.append(my_new_roi.getId().val)
-                else:
-                    if verbose:
-                        print("No spine found")
-                    # roi_spine_ids.append(non_roi_value)
-            # else:
-            #     roi_big_circle_ids.append(non_roi_value)
-            #     roi_spine_ids.append(non_roi_value)
-
-        # Create the table:
-        table_name = "Results_from_Fiji"
-        columns = []
-        for col_name in df.columns[1:]:
-            if col_name in non_numeric_columns:
-                columns.append(omero.grid.StringColumn(col_name, "", 256, []))
-            else:
-                columns.append(omero.grid.DoubleColumn(col_name, "", []))
-
-        # From Claire's groovy:
-        # table_columns[size] = new TableDataColumn("Roi", size, ROIData)
-        columns.append(omero.grid.RoiColumn("Roi", "", []))
-        # For the moment (20220729),
-        # the table support only one ROI column with link...
-        # if 'Elongation_index' in df.columns[1:]:
-        #     columns.append(omero.grid.RoiColumn('Roi_maxCircle', '', []))
-        #     columns.append(omero.grid.RoiColumn('Roi_Spine', '', []))
-        # columns.append(omero.grid.RoiColumn('Roi_main', '', []))
-
-        resources = conn.c.sf.sharedResources()
-        repository_id = \
-            resources.repositories().descriptions[0].getId().getValue()
-        table = resources.newTable(repository_id, table_name)
-        table.initialize(columns)
-
-        data = []
-        for col_name in df.columns[1:]:
-            if col_name in non_numeric_columns:
-                data.append(
-                    omero.grid.StringColumn(
-                        col_name, "", 256,
-                        df[col_name].astype("string").to_list()
-                    )
                 )
+                my_poly.setPoints(rstring(coos_formatted))
+                # Add a name
+                my_poly.setTextValue(rstring("spine" + str(i)))
+                rois.append((f"ROI spine{i}", new_roi(my_poly, image)))
             else:
-                data.append(
-                    omero.grid.DoubleColumn(col_name, "",
-                                            df[col_name].to_list())
+                rois.append((f"No spine found for ROI{i}", None))
+    return rois, polygon_indices
+
+
+def upload(conn, image_id, df, roi_files, verbose):
+    updateService = conn.getUpdateService()
+    # Create all ROIs of the image in one call
+    rois, polygon_indices = build_rois(image_id, roi_files)
+    saved_rois = iter(updateService.saveAndReturnArray(
+        [roi for _, roi in rois if roi is not None], conn.SERVICE_OPTS
+    ))
+    # The saved ROIs are in the same order
+    rois = [(description, None if roi is None else next(saved_rois))
+            for description, roi in rois]
+    if verbose:
+        for description, roi in rois:
+            if roi is None:
+                print(description)
+            else:
+                print(f"Created {description}: {roi.getId().val}.")
+    # The ROI of each row
+    roi_ids = [rois[k][1].getId().val for k in polygon_indices]
+
+    # Create the table:
+    table_name = "Results_from_Fiji"
+    columns = []
+    for col_name in df.columns[1:]:
+        if col_name in non_numeric_columns:
+            columns.append(omero.grid.StringColumn(col_name, "", 256, []))
+        else:
+            columns.append(omero.grid.DoubleColumn(col_name, "", []))
+
+    # From Claire's groovy:
+    # table_columns[size] = new TableDataColumn("Roi", size, ROIData)
+    columns.append(omero.grid.RoiColumn("Roi", "", []))
+    # For the moment (20220729),
+    # the table support only one ROI column with link...
+    # if 'Elongation_index' in df.columns[1:]:
+    #     columns.append(omero.grid.RoiColumn('Roi_maxCircle', '', []))
+    #     columns.append(omero.grid.RoiColumn('Roi_Spine', '', []))
+    # columns.append(omero.grid.RoiColumn('Roi_main', '', []))
+
+    resources = conn.c.sf.sharedResources()
+    repository_id = \
+        resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, table_name)
+    table.initialize(columns)
+
+    data = []
+    for col_name in df.columns[1:]:
+        if col_name in non_numeric_columns:
+            data.append(
+                omero.grid.StringColumn(
+                    col_name, "", 256,
+                    df[col_name].astype("string").to_list()
                 )
-        data.append(omero.grid.RoiColumn("Roi", "", roi_ids))
-        # if verbose:
-        #     print("Columns are " + " ".join(df.columns[1:]))
-        # if 'Elongation_index' in df.columns[1:]:
-        #     if verbose:
-        #         print("Adding 2 rois columns")
-        #         print(roi_ids)
-        #         print(roi_big_circle_ids)
-        #     data.append(omero.grid.RoiColumn('Roi_maxCircle', '',
-        #                                      roi_big_circle_ids))
-        #     data.append(omero.grid.RoiColumn('Roi_Spine', '',
-        #                                      roi_spine_ids))
-        # data.append(omero.grid.RoiColumn('Roi_main', '', roi_ids))
-
-        table.addData(data)
-        orig_file = table.getOriginalFile()
-        table.close()
-        # when we are done, close.
-
-        # Load the table as an original file
-
-        orig_file_id = orig_file.id.val
-        # ...so you can attach this data to an object e.g. Image
-        file_ann = omero.model.FileAnnotationI()
-        # use unloaded OriginalFileI
-        file_ann.setFile(omero.model.OriginalFileI(orig_file_id, False))
-        file_ann = updateService.saveAndReturnObject(file_ann)
-        link = omero.model.ImageAnnotationLinkI()
-        link.setParent(omero.model.ImageI(image_id, False))
-        link.setChild(omero.model.FileAnnotationI(
-            file_ann.getId().getValue(), False
-            ))
-        updateService.saveAndReturnObject(link)
-        if verbose:
-            print("Successfully created a Table with results.")
+            )
+        else:
+            data.append(
+                omero.grid.DoubleColumn(col_name, "",
+                                        df[col_name].to_list())
+            )
+    data.append(omero.grid.RoiColumn("Roi", "", roi_ids))
+    # if verbose:
+    #     print("Columns are " + " ".join(df.columns[1:]))
+    # if 'Elongation_index' in df.columns[1:]:
+    #     if verbose:
+    #         print("Adding 2 rois columns")
+    #         print(roi_ids)
+    #         print(roi_big_circle_ids)
+    #     data.append(omero.grid.RoiColumn('Roi_maxCircle', '',
+    #                                      roi_big_circle_ids))
+    #     data.append(omero.grid.RoiColumn('Roi_Spine', '',
+    #                                      roi_spine_ids))
+    # data.append(omero.grid.RoiColumn('Roi_main', '', roi_ids))
+
+    table.addData(data)
+    orig_file = table.getOriginalFile()
+    table.close()
+    # when we are done, close.
+
+    # Load the table as an original file
+
+    orig_file_id = orig_file.id.val
+    # ...so you can attach this data to an object e.g. Image
+    file_ann = omero.model.FileAnnotationI()
+    # use unloaded OriginalFileI
+    file_ann.setFile(omero.model.OriginalFileI(orig_file_id, False))
+    link = omero.model.ImageAnnotationLinkI()
+    link.setParent(omero.model.ImageI(image_id, False))
+    # The file annotation is saved with the link
+    link.setChild(file_ann)
+    updateService.saveAndReturnObject(link, conn.SERVICE_OPTS)
+    if verbose:
+        print("Successfully created a Table with results.")
+
+
+def get_dataset_ids(conn, image_ids):
+    """Return a dictionary image id -> id of its dataset
+    (with one query for all images)"""
+    params = ParametersI()
+    params.addIds([int(image_id) for image_id in image_ids])
+    rows = conn.getQueryService().projection(
+        "select l.child.id, l.parent.id from DatasetImageLink l"
+        " where l.child.id in (:ids) order by l.parent.id desc",
+        params, conn.SERVICE_OPTS
+    )
+    # The first dataset of each image is kept
+    return {image_id: dataset_id
+            for image_id, dataset_id in unwrap(rows)}
 
 
 def scan_and_upload(
@@ -279,67 +275,52 @@ def scan_and_upload(
 ):
     # First get the summary results
     full_df = pd.read_csv(summary_results)
-    # Loop over the image names
-    for image_file_name in np.unique(full_df["Label"]):
-        # Get the image_id
-        image_id = get_image_id(image_file_name)
-        if verbose:
-            print(f"Image:{image_id} is in the table."
-                  " Cleaning old results.")
-        clean(
-            image_id, omero_username, omero_password, omero_host,
-            omero_secured, verbose
-        )
-        # Subset the result to the current image
-        df = full_df[full_df["Label"] == image_file_name]
-        if np.isnan(df["Area"].to_list()[0]):
-            # No ROI has been detected
-            if verbose:
-                print("No ROI was found.")
-            continue
-        n_rois = df.shape[0]
-        if verbose:
-            print(f"I found {n_rois} measurements.")
-        # Check the corresponding rois exists
-        roi_files = [
-            os.path.join(
-                roi_directory,
-                image_file_name.replace(".tiff", "_tiff")
-                + "__"
-                + str(i)
-                + "_roi_coordinates.txt",
-            )
-            for i in range(n_rois)
-        ]
-        for ro_file in roi_files:
-            if not os.path.exists(ro_file):
-                raise Exception(f"Could not find {ro_file}")
-        upload(
-            image_id,
-            df,
-            roi_files,
-            omero_username,
-            omero_password,
-            omero_host,
-            omero_secured,
-            verbose,
-        )
-    # Update the full_df with image id:
-    full_df["id"] = [
-        get_image_id(image_file_name)
-        for image_file_name in full_df["Label"]
-    ]
-    # Attach it to the dataset:
+    # All the images are processed with one session
     with BlitzGateway(
         omero_username, omero_password, host=omero_host,
         secure=omero_secured
     ) as conn:
-        full_df["dataset_id"] = [
-            a.id
-            for id in full_df["id"]
-            for a in conn.getObject("Image", id).getAncestry()
-            if a.OMERO_CLASS == "Dataset"
+        # Loop over the image names
+        for image_file_name in np.unique(full_df["Label"]):
+            # Get the image_id
+            image_id = get_image_id(image_file_name)
+            if verbose:
+                print(f"Image:{image_id} is in the table."
+                      " Cleaning old results.")
+            clean(conn, image_id, verbose)
+            # Subset the result to the current image
+            df = full_df[full_df["Label"] == image_file_name]
+            if np.isnan(df["Area"].to_list()[0]):
+                # No ROI has been detected
+                if verbose:
+                    print("No ROI was found.")
+                continue
+            n_rois = df.shape[0]
+            if verbose:
+                print(f"I found {n_rois} measurements.")
+            # Check the corresponding rois exists
+            roi_files = [
+                os.path.join(
+                    roi_directory,
+                    image_file_name.replace(".tiff", "_tiff")
+                    + "__"
+                    + str(i)
+                    + "_roi_coordinates.txt",
+                )
+                for i in range(n_rois)
+            ]
+            for ro_file in roi_files:
+                if not os.path.exists(ro_file):
+                    raise Exception(f"Could not find {ro_file}")
+            upload(conn, image_id, df, roi_files, verbose)
+        # Update the full_df with image id:
+        full_df["id"] = [
+            get_image_id(image_file_name)
+            for image_file_name in full_df["Label"]
         ]
+        # Attach it to the dataset:
+        dataset_ids = get_dataset_ids(conn, np.unique(full_df["id"]))
+        full_df["dataset_id"] = [dataset_ids[id] for id in full_df["id"]]
         dir = tempfile.mkdtemp()
         for dataset_id in np.unique(full_df["dataset_id"]):
             df = full_df[full_df["dataset_id"] == dataset_id]